@@ -4,10 +4,16 @@ import pandas as pd
 import streamlit as st
 import time
 
-from src.utils.io import ensure_data_ready, load_datasets, regenerate_datasets
-from src.analytics.metrics import compute_kpis
-from src.analytics.funnel import build_funnel, plot_funnel
-from src.analytics.cohorts import build_cohorts, plot_retention
+from src.utils.io import dataset_fingerprint, dataset_parent, ensure_data_ready, load_event_store, load_users, regenerate_datasets
+from src.data.store import EventStore
+from src.data.ingest import file_digest, ingest_events_csv, ingest_users_csv
+from src.data.segments import SegmentIndex
+from src.utils.cache import LRUCache, estimate_nbytes
+from src.analytics.metrics import compute_kpis, plot_rolling_actives, plot_stickiness, rolling_active_users
+from src.analytics.rollup import DailyRollup
+from src.analytics.sketch import DEFAULT_ERROR, DailySketches
+from src.analytics.funnel import build_funnel, build_funnels, funnel_engine, plot_funnel, plot_funnel_breakdown, plot_time_to_convert
+from src.analytics.cohorts import COHORT_METRICS, build_cohorts, plot_retention, stack_cohorts
 from src.analytics.anomaly import compute_daily_metrics, detect_anomalies, plot_metric_with_anomalies
 from src.tools.abtest import ab_sample_size, ab_detectable_effect
 from src.tools.rice import score_rice
@@ -262,13 +268,76 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-@st.cache_data(show_spinner=False, ttl=300)  # 5 minute cache
-def _load_data_cached():
+@st.cache_resource(show_spinner=False, max_entries=2)  # keyed by dataset content hash
+def _load_data_cached(fingerprint: str):
+    # cache_resource hands every session the same objects instead of unpickling
+    # a copy, so the memory-mapped event store stays shared
     with st.spinner("Loading data..."):
-        ensure_data_ready()
-        return load_datasets()
+        return load_users(), load_event_store()
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _ingest_upload_cached(kind: str, digest: str, _upload):
+    # Keyed by content hash, so reruns with the uploader populated reuse the parse
+    if kind == "users":
+        return ingest_users_csv(_upload)
+    return ingest_events_csv(_upload)
+
+def _ingest_upload(kind: str, upload):
+    # Hash each uploaded file once per session rather than on every rerun
+    digests = st.session_state.setdefault("upload_digests", {})
+    file_key = (kind, getattr(upload, "file_id", upload.name), upload.size)
+    if file_key not in digests:
+        digests[file_key] = file_digest(upload)
+    return digests[file_key], _ingest_upload_cached(kind, digests[file_key], upload)
+
+# Memory budget for cached filter results and what pages derive from them
+# (funnel engines and prefix states, cohort tables), shared by all sessions
+FILTER_CACHE_BYTES = int(os.environ.get("FILTER_CACHE_MB", "256")) * 1024 * 1024
+
+@st.cache_resource(show_spinner=False)
+def _filter_cache():
+    return LRUCache(FILTER_CACHE_BYTES)
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _segment_index_cached(users_key: str, _users: pd.DataFrame):
+    return SegmentIndex(_users)
+
+# Memory budget for per-dataset aggregate state (rollup, sketches)
+STATE_CACHE_BYTES = int(os.environ.get("STATE_CACHE_MB", "512")) * 1024 * 1024
 
-def sidebar_controls(users: pd.DataFrame, events: pd.DataFrame):
+@st.cache_resource(show_spinner=False)
+def _state_cache():
+    return LRUCache(STATE_CACHE_BYTES)
+
+def _dataset_state(kind: tuple, dataset_key: tuple, parent: dict | None, events: EventStore, segments: SegmentIndex, build):
+    # Aggregates are built over the unfiltered events, once per dataset. A
+    # topped-up dataset extends its parent's state with just the appended
+    # rows instead of rebuilding; filters become segment selections
+    cache = _state_cache()
+    state = cache.get((kind, dataset_key))
+    if state is None:
+        base = cache.get((kind, (parent["content_hash"],) * 2)) if parent else None
+        try:
+            state = base.append(events.take(slice(parent["events_rows"], None)), segments) if base is not None else None
+        except ValueError:
+            state = None
+        if state is None:
+            state = build(events, segments)
+        size = estimate_nbytes(state)
+        if size > cache.max_bytes:
+            st.sidebar.warning(f"⚠️ {kind[0].title()} needs {size / 2**20:,.0f} MB, over STATE_CACHE_MB; it is rebuilt on every rerun")
+        cache.put((kind, dataset_key), state, size)
+    return state
+
+def _show_ingest_report(label: str, rows: int, report: pd.DataFrame, errors: int):
+    if errors:
+        st.sidebar.warning(f"⚠️ {label} loaded ({rows:,} rows); skipped {errors:,} invalid values")
+        with st.sidebar.expander("Rejected values"):
+            st.dataframe(report, use_container_width=True)
+    else:
+        st.sidebar.success(f"✅ {label} loaded ({rows:,} rows)")
+
+def sidebar_controls(segments: SegmentIndex, events: EventStore):
     st.sidebar.header("📊 Data Source")
     st.sidebar.caption("Upload your own CSVs or use synthetic data")
     
@@ -293,15 +362,19 @@ def sidebar_controls(users: pd.DataFrame, events: pd.DataFrame):
 
     if upload_users is not None:
         try:
-            st.session_state["users_override"] = pd.read_csv(upload_users)
-            st.sidebar.success("✅ Users data loaded")
+            digest, (uploaded_users, report, errors) = _ingest_upload("users", upload_users)
+            st.session_state["users_override"] = uploaded_users
+            st.session_state["users_override_key"] = digest
+            _show_ingest_report("Users data", len(uploaded_users), report, errors)
         except Exception as e:
             st.sidebar.error(f"❌ Error loading users: {e}")
             
     if upload_events is not None:
         try:
-            st.session_state["events_override"] = pd.read_csv(upload_events, parse_dates=["event_time"])
-            st.sidebar.success("✅ Events data loaded")
+            digest, (uploaded_events, report, errors) = _ingest_upload("events", upload_events)
+            st.session_state["events_override"] = uploaded_events
+            st.session_state["events_override_key"] = digest
+            _show_ingest_report("Events data", len(uploaded_events), report, errors)
         except Exception as e:
             st.sidebar.error(f"❌ Error loading events: {e}")
 
@@ -310,7 +383,6 @@ def sidebar_controls(users: pd.DataFrame, events: pd.DataFrame):
     if st.sidebar.button("🔄 Regenerate Synthetic Data", help="Generate fresh data up to today"):
         with st.spinner("Generating fresh data..."):
             regenerate_datasets()
-            st.cache_data.clear()
             st.sidebar.success("✅ Data regenerated!")
             time.sleep(1)
             st.rerun()
@@ -319,8 +391,9 @@ def sidebar_controls(users: pd.DataFrame, events: pd.DataFrame):
     st.sidebar.header("🎯 Global Filters")
     
     # Enhanced date picker
-    date_min = events["event_time"].min().date()
-    date_max = max(events["event_time"].max().date(), pd.Timestamp.today().date())
+    first_event, last_event = events.time_range()
+    date_min = first_event.date()
+    date_max = max(last_event.date(), pd.Timestamp.today().date())
     start, end = st.sidebar.date_input(
         "📅 Date Range", 
         value=(date_min, date_max), 
@@ -329,25 +402,17 @@ def sidebar_controls(users: pd.DataFrame, events: pd.DataFrame):
         help="Filter data by date range"
     )
     
-    # Enhanced channel/country selectors with error handling
-    try:
-        channels = ["All"] + sorted(users["acq_channel"].dropna().unique().tolist()) if "acq_channel" in users.columns else ["All"]
-    except:
-        channels = ["All"]
-    
-    try:
-        countries = ["All"] + sorted(users["country"].dropna().unique().tolist()) if "country" in users.columns else ["All"]
-    except:
-        countries = ["All"]
-    
-    sel_channel = st.sidebar.selectbox(
+    # Enhanced channel/country selectors; leaving one empty means "All"
+    sel_channels = st.sidebar.multiselect(
         "📈 Acquisition Channel", 
-        channels, 
+        segments.values("acq_channel"), 
+        placeholder="All",
         help="Filter by user acquisition source"
     )
-    sel_country = st.sidebar.selectbox(
+    sel_countries = st.sidebar.multiselect(
         "🌍 Country", 
-        countries,
+        segments.values("country"),
+        placeholder="All",
         help="Filter by user location"
     )
 
@@ -358,31 +423,71 @@ def sidebar_controls(users: pd.DataFrame, events: pd.DataFrame):
     st.sidebar.markdown("• Size A/B tests before running them")
     st.sidebar.markdown("• Export data for further analysis")
     
-    return pd.Timestamp(start), pd.Timestamp(end) + pd.Timedelta(days=1), sel_channel, sel_country
+    return pd.Timestamp(start), pd.Timestamp(end) + pd.Timedelta(days=1), sel_channels, sel_countries
 
 
-def apply_global_filters(users: pd.DataFrame, events: pd.DataFrame, start_ts: pd.Timestamp, end_ts: pd.Timestamp, channel: str, country: str):
-    filtered_events = events[(events["event_time"] >= start_ts) & (events["event_time"] < end_ts)].copy()
-    filtered_users = users.copy()
-    
-    if channel != "All":
-        uids = filtered_users[filtered_users["acq_channel"] == channel]["user_id"].unique()
-        filtered_events = filtered_events[filtered_events["user_id"].isin(uids)]
-        filtered_users = filtered_users[filtered_users["user_id"].isin(uids)]
-        
-    if country != "All":
-        uids = filtered_users[filtered_users["country"] == country]["user_id"].unique()
-        filtered_events = filtered_events[filtered_events["user_id"].isin(uids)]
-        filtered_users = filtered_users[filtered_users["user_id"].isin(uids)]
-        
-    return filtered_users, filtered_events
+def approximate_controls():
+    # HyperLogLog active-user counts: merges per-day sketches instead of
+    # rescanning events, which pays off on long date ranges
+    approximate = st.sidebar.toggle(
+        "≈ Approximate active users",
+        value=False,
+        help="Estimate DAU/WAU/MAU with HyperLogLog sketches. Exact counts always come from the daily rollup; "
+        "its per-user activity grows with users × active days, while sketches stay fixed per day and segment, "
+        "so estimates are for datasets with too many users for the exact path"
+    )
+    error = DEFAULT_ERROR
+    if approximate:
+        error = st.sidebar.select_slider(
+            "Target error",
+            options=[0.01, 0.02, 0.05],
+            value=DEFAULT_ERROR,
+            format_func=lambda e: f"±{e:.1%}",
+            help="Standard error of the estimates; lower costs more memory"
+        )
+    return approximate, error
+
+
+def apply_global_filters(users: pd.DataFrame, events: EventStore, segments: SegmentIndex, start_ts: pd.Timestamp, end_ts: pd.Timestamp, channels: list[str], countries: list[str]):
+    # Events are time-sorted, so the date range is a binary-searched slice
+    rows = events.time_slice(start_ts, end_ts)
+    selected = segments.select({"acq_channel": channels, "country": countries})
+    if selected is None:
+        return users, events.take(rows)
+
+    # Segment users come from the bitmaps, their events from the per-user row index
+    user_rows = segments.user_rows(selected)
+    candidates = events.rows_for_users(segments.user_ids[user_rows])
+    keep = candidates[(candidates >= rows.start) & (candidates < rows.stop)]
+    return users.iloc[user_rows], events.take(keep)
+
+
+def filter_key(dataset_key: tuple, start_ts: pd.Timestamp, end_ts: pd.Timestamp, channels: list[str], countries: list[str]) -> tuple:
+    # Identifies one filtered view of one dataset
+    return (dataset_key, start_ts.value, end_ts.value, tuple(sorted(channels)), tuple(sorted(countries)))
 
+def view_nbytes(users: pd.DataFrame, view: tuple) -> int:
+    # A view is charged for its events and the indexes built on them so far,
+    # but not for the users table when it is the shared, unfiltered one
+    users_f, events_f = view
+    return (0 if users_f is users else estimate_nbytes(users_f)) + estimate_nbytes(events_f)
 
-def page_overview(users: pd.DataFrame, events: pd.DataFrame, start_ts: pd.Timestamp, end_ts: pd.Timestamp):
+def apply_global_filters_cached(dataset_key: tuple, users: pd.DataFrame, events: EventStore, segments: SegmentIndex, start_ts: pd.Timestamp, end_ts: pd.Timestamp, channels: list[str], countries: list[str]):
+    # Reruns that only change the page or chart controls reuse the filtered views
+    cache = _filter_cache()
+    key = filter_key(dataset_key, start_ts, end_ts, channels, countries)
+    result = cache.get(key)
+    if result is None:
+        result = apply_global_filters(users, events, segments, start_ts, end_ts, channels, countries)
+        cache.put(key, result, view_nbytes(users, result))
+    return result
+
+
+def page_overview(users: pd.DataFrame, events: EventStore, start_ts: pd.Timestamp, end_ts: pd.Timestamp, rollup: DailyRollup | None = None, sketches: DailySketches | None = None, selections: dict | None = None):
     st.subheader("📊 KPI Dashboard")
     
     with st.spinner("Computing KPIs..."):
-        kpis = compute_kpis(users, events, start_ts, end_ts)
+        kpis = compute_kpis(users, events, start_ts, end_ts, sketches=sketches, selections=selections, rollup=rollup)
     
     # Enhanced metrics display
     m1, m2, m3, m4 = st.columns(4)
@@ -410,9 +515,11 @@ def page_overview(users: pd.DataFrame, events: pd.DataFrame, start_ts: pd.Timest
             f"{kpis['conversion_rate']*100:.1f}%",
             help="Signup to purchase conversion"
         )
+    if sketches is not None:
+        st.caption(f"≈ Active users are HyperLogLog estimates (±{sketches.relative_error:.1%} standard error)")
 
     # Enhanced tabs
-    tabs = st.tabs(["📈 Retention Analysis", "📝 Key Insights", "📊 Data Summary"])
+    tabs = st.tabs(["📈 Retention Analysis", "📉 Active Users Trend", "📝 Key Insights", "📊 Data Summary"])
     
     with tabs[0]:
         st.markdown("### User Retention by Cohort")
@@ -427,17 +534,35 @@ def page_overview(users: pd.DataFrame, events: pd.DataFrame, start_ts: pd.Timest
                 help="Download retention data"
             )
         st.dataframe(ret.style.format({"retention": "{:.1%}"}), use_container_width=True)
-    
+
     with tabs[1]:
+        st.markdown("### Trailing Active Users & Stickiness")
+        rolling = rolling_active_users(events, start_ts, end_ts, rollup=rollup, selections=selections)
+        col1, col2 = st.columns([3, 1])
+        with col2:
+            st.download_button(
+                "📥 Download CSV", 
+                data=rolling.to_csv(index=False).encode("utf-8"), 
+                file_name="active_users_trend.csv", 
+                mime="text/csv"
+            )
+        if rolling.empty:
+            st.info("No activity in the selected range")
+        else:
+            st.plotly_chart(plot_rolling_actives(rolling), use_container_width=True)
+            st.plotly_chart(plot_stickiness(rolling), use_container_width=True)
+    
+    with tabs[2]:
         st.markdown("### 💡 Key Insights")
         st.markdown("""
         - **DAU/WAU/MAU**: Track user engagement trends
+        - **Stickiness**: DAU as a share of trailing 7/28-day actives
         - **Conversion Rate**: Monitor signup → purchase funnel
         - **Retention**: Understand user lifecycle patterns
         - **Use filters** to analyze specific segments
         """)
     
-    with tabs[2]:
+    with tabs[3]:
         st.markdown("### 📊 Data Summary")
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -448,12 +573,12 @@ def page_overview(users: pd.DataFrame, events: pd.DataFrame, start_ts: pd.Timest
             st.metric("Date Range", f"{(end_ts - start_ts).days} days")
 
 
-def page_funnel(events: pd.DataFrame):
+def page_funnel(events: EventStore, segments: SegmentIndex, view_key: tuple):
     st.subheader("🔄 Funnel Analysis")
     st.markdown("Analyze user journey and identify drop-off points")
     
     # Enhanced input controls
-    col1, col2 = st.columns([2, 1])
+    col1, col2, col3 = st.columns([2, 1, 1])
     with col1:
         steps_default = ["view", "signup", "activate", "purchase"]
         steps = st.text_input(
@@ -470,9 +595,20 @@ def page_funnel(events: pd.DataFrame):
             max_value=60,
             help="Maximum time between steps"
         )
+    with col3:
+        breakdown_labels = {"None": None, "Acquisition Channel": "acq_channel", "Country": "country"}
+        breakdown = breakdown_labels[st.selectbox(
+            "🧩 Break Down By",
+            list(breakdown_labels),
+            help="Step counts per segment value, from one pass over events"
+        )]
 
     with st.spinner("Building funnel analysis..."):
-        funnel_df = build_funnel(events, steps, pd.Timedelta(days=window_days))
+        cache = _filter_cache()
+        engine = funnel_engine(events, cache, view_key)
+        if engine.nbytes > cache.max_bytes:
+            st.sidebar.warning(f"⚠️ Funnel index needs {engine.nbytes / 2**20:,.0f} MB, over FILTER_CACHE_MB; it is rebuilt on every rerun")
+        funnel_df, ttc_df = build_funnel(engine, steps, pd.Timedelta(days=window_days), segments, breakdown, timing=True)
     
     # Enhanced display
     col1, col2 = st.columns([3, 1])
@@ -484,14 +620,46 @@ def page_funnel(events: pd.DataFrame):
             mime="text/csv"
         )
     
-    st.dataframe(funnel_df, use_container_width=True)
+    if breakdown is None:
+        st.dataframe(funnel_df, use_container_width=True)
+    else:
+        # One column per segment value; steps may repeat, so no pivot
+        wide = pd.DataFrame({value: group["users"].to_numpy() for value, group in funnel_df.groupby(breakdown, sort=False)}, index=pd.Index(steps, name="step"))
+        st.dataframe(wide, use_container_width=True)
     
     if not funnel_df.empty:
-        fig = plot_funnel(funnel_df)
+        fig = plot_funnel(funnel_df) if breakdown is None else plot_funnel_breakdown(funnel_df, breakdown)
         st.plotly_chart(fig, use_container_width=True)
 
+    if not ttc_df.empty:
+        st.markdown("### ⏱️ Time to Convert")
+        st.caption("Hours from the earliest first-step event that leads to each later step, from fixed log-spaced buckets (quantiles within ~19%)")
+        st.plotly_chart(plot_time_to_convert(ttc_df), use_container_width=True)
+        if breakdown is not None:
+            st.dataframe(funnel_df.drop(columns="users"), use_container_width=True)
 
-def page_cohorts(events: pd.DataFrame):
+    with st.expander("🧪 Compare Funnel Variants"):
+        variants = st.text_area(
+            "One funnel per line (comma-separated steps)",
+            value="view,signup,activate,purchase\nview,signup,activate\nview,signup,purchase",
+            help="Variants sharing leading steps reuse them instead of recomputing"
+        )
+        variants = [[s.strip() for s in line.split(",") if s.strip()] for line in variants.splitlines()]
+        variants = [v for v in variants if v]
+        if variants:
+            frames = build_funnels(engine, variants, pd.Timedelta(days=window_days))
+            rows = []
+            for variant, frame in zip(variants, frames):
+                rows.append({
+                    "variant": " → ".join(variant),
+                    "first_step_users": int(frame["users"].iloc[0]),
+                    "converted_users": int(frame["users"].iloc[-1]),
+                    "conversion": frame["users"].iloc[-1] / max(frame["users"].iloc[0], 1),
+                })
+            st.dataframe(pd.DataFrame(rows), use_container_width=True)
+
+
+def page_cohorts(events: EventStore, view_key: tuple):
     st.subheader("👥 Cohort Analysis")
     st.markdown("Understand user retention patterns over time")
     
@@ -514,31 +682,51 @@ def page_cohorts(events: pd.DataFrame):
     with col3:
         period = st.selectbox(
             "📅 Period", 
-            options=["weekly", "monthly"], 
-            index=0,
+            options=["daily", "weekly", "monthly", "custom"], 
+            index=1,
             help="Cohort grouping frequency"
         )
+        if period == "custom":
+            period = int(st.number_input("Period length (days)", value=14, min_value=1, max_value=90))
 
-    with st.spinner("Computing cohort analysis..."):
-        cohorts = build_cohorts(events, cohort_event=cohort_event, outcome_event=outcome_event, period=period)
+    # All metrics come from one build, cached per view, so switching the
+    # displayed metric doesn't recompute
+    cache = _filter_cache()
+    key = ("cohorts", view_key, cohort_event, outcome_event, period)
+    tables = cache.get(key)
+    if tables is None:
+        with st.spinner("Computing cohort analysis..."):
+            tables = build_cohorts(events, cohort_event=cohort_event, outcome_event=outcome_event, period=period)
+        cache.put(key, tables)
     
     col1, col2 = st.columns([3, 1])
+    with col1:
+        metric = st.radio(
+            "📐 Metric",
+            options=list(COHORT_METRICS),
+            format_func=COHORT_METRICS.get,
+            horizontal=True
+        )
     with col2:
         st.download_button(
             "📥 Download CSV", 
-            data=cohorts.to_csv().encode("utf-8"), 
+            data=stack_cohorts(tables).to_csv(index=False).encode("utf-8"), 
             file_name="cohorts.csv", 
-            mime="text/csv"
+            mime="text/csv",
+            help="Every metric and the cohort sizes, one row per cohort and period"
         )
     
-    st.dataframe(cohorts.style.format("{:.1%}"), use_container_width=True)
+    cohorts = tables[metric]
+    st.dataframe(cohorts.style.format("{:.2f}" if metric == "events_per_user" else "{:.1%}"), use_container_width=True)
     
     if not cohorts.empty:
-        fig = plot_retention(cohorts)
+        fig = plot_retention(cohorts, COHORT_METRICS[metric])
         st.plotly_chart(fig, use_container_width=True)
+        with st.expander("👥 Cohort Sizes"):
+            st.dataframe(tables["size"], use_container_width=True)
 
 
-def page_anomalies(events: pd.DataFrame):
+def page_anomalies(events: EventStore, rollup: DailyRollup | None = None, sketches: DailySketches | None = None, selections: dict | None = None):
     st.subheader("🚨 Anomaly Detection")
     st.markdown("Identify unusual patterns in your metrics")
     
@@ -558,7 +746,9 @@ def page_anomalies(events: pd.DataFrame):
         )
 
     with st.spinner("Detecting anomalies..."):
-        metrics = compute_daily_metrics(events)
+        metrics = compute_daily_metrics(events, sketches=sketches, selections=selections, rollup=rollup)
+    if sketches is not None:
+        st.caption(f"≈ DAU is a HyperLogLog estimate (±{sketches.relative_error:.1%} standard error)")
 
     # Enhanced charts
     for col, title in [("dau", "👥 DAU"), ("signups", "📝 Signups"), ("purchasers", "💰 Purchasers"), ("conversion", "📈 Conversion")]:
@@ -717,7 +907,7 @@ def page_rice():
         st.error(f"❌ Error calculating RICE scores: {e}")
 
 
-def page_prd(users: pd.DataFrame, events: pd.DataFrame):
+def page_prd(users: pd.DataFrame, events: EventStore):
     st.subheader("📋 PRD Generator")
     st.markdown("Create a professional Product Requirements Document")
     
@@ -754,8 +944,7 @@ def page_prd(users: pd.DataFrame, events: pd.DataFrame):
         with col2:
             st.markdown("#### 📊 Current Metrics")
             try:
-                start_ts = events["event_time"].min()
-                end_ts = events["event_time"].max()
+                start_ts, end_ts = events.time_range()
                 kpis = compute_kpis(users, events, start_ts, end_ts)
                 
                 st.metric("Conversion Rate", f"{kpis['conversion_rate']*100:.1f}%", help="Signup to purchase conversion")
@@ -820,8 +1009,7 @@ def page_prd(users: pd.DataFrame, events: pd.DataFrame):
         if st.button("🔄 Generate PRD", type="primary", use_container_width=True):
             try:
                 # Get current metrics for summary
-                start_ts = events["event_time"].min()
-                end_ts = events["event_time"].max()
+                start_ts, end_ts = events.time_range()
                 kpis = compute_kpis(users, events, start_ts, end_ts)
                 summary = f"Current conversion {kpis['conversion_rate']*100:.1f}%. Avg DAU {kpis['dau_avg']:.0f}."
             except:
@@ -872,15 +1060,31 @@ def page_prd(users: pd.DataFrame, events: pd.DataFrame):
 def main():
     # Enhanced loading with professional branding
     with st.spinner("🚀 Loading Product Analytics Enterprise Platform..."):
-        users, events = _load_data_cached()
+        ensure_data_ready()
+        fingerprint = dataset_fingerprint()
+        users, events = _load_data_cached(fingerprint)
     
+    users_key = events_key = fingerprint
     if "users_override" in st.session_state:
         users = st.session_state["users_override"]
+        users_key = st.session_state["users_override_key"]
     if "events_override" in st.session_state:
         events = st.session_state["events_override"]
+        events_key = st.session_state["events_override_key"]
+    segments = _segment_index_cached(users_key, users)
 
-    start_ts, end_ts, sel_channel, sel_country = sidebar_controls(users, events)
-    users_f, events_f = apply_global_filters(users, events, start_ts, end_ts, sel_channel, sel_country)
+    start_ts, end_ts, sel_channels, sel_countries = sidebar_controls(segments, events)
+    users_f, events_f = apply_global_filters_cached((users_key, events_key), users, events, segments, start_ts, end_ts, sel_channels, sel_countries)
+    view_key = filter_key((users_key, events_key), start_ts, end_ts, sel_channels, sel_countries)
+    # Only the stored dataset has a lineage; uploads are standalone datasets
+    parent = dataset_parent() if (users_key, events_key) == (fingerprint, fingerprint) else None
+    rollup = _dataset_state(("rollup",), (users_key, events_key), parent, events, segments, DailyRollup.build)
+    approximate, error = approximate_controls()
+    if approximate:
+        sketches = _dataset_state(("sketches", error), (users_key, events_key), parent, events, segments, lambda e, s: DailySketches.build(e, s, error=error))
+    else:
+        sketches = None
+    selections = {"acq_channel": sel_channels, "country": sel_countries}
 
     # Professional header with premium logo
     st.markdown("""
@@ -908,13 +1112,13 @@ def main():
 
     # Route to pages
     if "Overview" in page:
-        page_overview(users_f, events_f, start_ts, end_ts)
+        page_overview(users_f, events_f, start_ts, end_ts, rollup, sketches, selections)
     elif "Funnel" in page:
-        page_funnel(events_f)
+        page_funnel(events_f, segments, view_key)
     elif "Cohorts" in page:
-        page_cohorts(events_f)
+        page_cohorts(events_f, view_key)
     elif "Anomalies" in page:
-        page_anomalies(events_f)
+        page_anomalies(events_f, rollup, sketches, selections)
     elif "A/B Test" in page:
         page_abtest()
     elif "RICE" in page:
@@ -922,6 +1126,10 @@ def main():
     else:
         page_prd(users_f, events_f)
 
+    # Pages build per-user and per-event indexes on the view lazily; charge
+    # them to its cache entry now that they exist
+    _filter_cache().resize(view_key, view_nbytes(users, (users_f, events_f)))
+
 
 if __name__ == "__main__":
     main()
@@ -369,7 +369,7 @@ def page_cohorts(events: pd.DataFrame):
         )
 
     with st.spinner("Computing cohort analysis..."):
-        cohorts = build_cohorts(events, cohort_event=cohort_event, outcome_event=outcome_event, period=period)
+        cohorts = build_cohorts(events, cohort_event=cohort_event, outcome_event=outcome_event, period=period)["retention"]
     
     col1, col2 = st.columns([3, 1])
     with col2:
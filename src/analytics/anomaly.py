@@ -1,14 +1,37 @@
 import pandas as pd
 import numpy as np
 import plotly.express as px
+from src.analytics.metrics import DAY_NS
+from src.data.store import EventStore, as_event_store
 
 
-def compute_daily_metrics(events: pd.DataFrame) -> pd.DataFrame:
-	frame = events.copy()
-	frame["date"] = frame["event_time"].dt.date
-	daily_users = frame.groupby("date")["user_id"].nunique().rename("dau").reset_index()
-	purchasers = frame[frame["event_name"] == "purchase"].groupby("date")["user_id"].nunique().rename("purchasers").reset_index()
-	signups = frame[frame["event_name"] == "signup"].groupby("date")["user_id"].nunique().rename("signups").reset_index()
+def _daily_frame(days: np.ndarray, values: np.ndarray, column: str) -> pd.DataFrame:
+	return pd.DataFrame({"date": pd.to_datetime(days * DAY_NS).date, column: values})
+
+
+def compute_daily_metrics(events: pd.DataFrame | EventStore, sketches=None, selections: dict[str, list[str]] | None = None, rollup=None) -> pd.DataFrame:
+	# rollup (a DailyRollup) and sketches (a DailySketches) are built over the
+	# unfiltered events and answer for the selections over the events' date
+	# range: the rollup exactly from its day cube, sketches as dau estimates
+	events = as_event_store(events)
+	if not len(events):
+		rollup = sketches = None
+	else:
+		first, last = events.time_range()
+		span = (first.normalize(), last.normalize() + pd.Timedelta(days=1))
+	if rollup is not None:
+		daily_users, signups, purchasers = (
+			_daily_frame(*rollup.daily(name, *span, selections)[:2], column)
+			for name, column in [(None, "dau"), ("signup", "signups"), ("purchase", "purchasers")]
+		)
+	else:
+		frame = events.code_frame()
+		frame["date"] = frame["event_time"].dt.date
+		daily_users = frame.groupby("date")["user_id"].nunique().rename("dau").reset_index()
+		purchasers = frame.iloc[events.rows("purchase")].groupby("date")["user_id"].nunique().rename("purchasers").reset_index()
+		signups = frame.iloc[events.rows("signup")].groupby("date")["user_id"].nunique().rename("signups").reset_index()
+	if sketches is not None:
+		daily_users = _daily_frame(*sketches.actives("day", *span, selections), "dau")
 	metrics = daily_users.merge(signups, on="date", how="left").merge(purchasers, on="date", how="left").fillna(0)
 	metrics["conversion"] = metrics.apply(lambda r: (r["purchasers"] / r["signups"]) if r["signups"] > 0 else 0.0, axis=1)
 	metrics = metrics.sort_values("date")
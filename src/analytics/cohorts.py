@@ -1,41 +1,127 @@
+import numpy as np
 import pandas as pd
 import plotly.express as px
+from src.analytics.metrics import DAY_NS, period_keys
+from src.data.store import EventStore, as_event_store
 
+# Named periods and the period_keys key they use; any int N is an N-day
+# period counted from the first cohort day
+PERIODS = {"daily": "day", "weekly": "week", "monthly": "month"}
 
-def build_cohorts(events: pd.DataFrame, cohort_event: str = "signup", outcome_event: str = "purchase", period: str = "weekly") -> pd.DataFrame:
-	# Map each user to first cohort_event time and its period bucket
-	events = events.copy()
-	cohort_src = events[events["event_name"] == cohort_event][["user_id", "event_time"]].sort_values("event_time").drop_duplicates("user_id")
-	period_freq = "W" if period == "weekly" else "M"
-	cohort_src["cohort_period"] = cohort_src["event_time"].dt.to_period(period_freq)
 
-	# Outcomes joined to cohort and compute period offset
-	outcomes = events[events["event_name"] == outcome_event][["user_id", "event_time"]].copy()
-	if outcomes.empty or cohort_src.empty:
-		return pd.DataFrame()
-	outcomes = outcomes.merge(cohort_src[["user_id", "event_time", "cohort_period"]].rename(columns={"event_time": "cohort_time"}), on="user_id", how="inner")
-	outcomes["out_period"] = outcomes["event_time"].dt.to_period(period_freq)
-	outcomes["period_index"] = (outcomes["out_period"] - outcomes["cohort_period"]).apply(lambda x: x.n)
-	outcomes = outcomes[outcomes["period_index"] >= 0]
+def period_codes(times: np.ndarray, period: str | int, anchor_day: int = 0) -> np.ndarray:
+	# Integer period numbers of int64 ns timestamps: consecutive periods
+	# differ by 1, so period offsets are plain subtraction
+	if period in PERIODS:
+		return period_keys(times)[PERIODS[period]]
+	return (times // DAY_NS - anchor_day) // int(period)
 
-	# Cohort sizes
-	cohort_sizes = cohort_src.groupby("cohort_period")["user_id"].nunique().rename("size").reset_index()
 
-	# Unique converting users per cohort by period index
-	ret = outcomes.groupby(["cohort_period", "period_index"])['user_id'].nunique().reset_index()
-	ret = ret.merge(cohort_sizes, on="cohort_period", how="left")
-	ret["retention"] = ret["user_id"] / ret["size"].replace(0, 1)
+def period_labels(codes: np.ndarray, period: str | int, anchor_day: int = 0) -> list[str]:
+	# Same labels as pandas Periods: a date, a month, or a first/last day range
+	if period == "monthly":
+		return [str(m) for m in codes.astype("datetime64[M]")]
+	if period == "daily":
+		return [str(d) for d in codes.astype("datetime64[D]")]
+	length = 7 if period == "weekly" else int(period)
+	first = codes * 7 - 3 if period == "weekly" else anchor_day + codes * length
+	return [f"{a}/{b}" for a, b in zip(first.astype("datetime64[D]"), (first + length - 1).astype("datetime64[D]"))]
 
-	pivot = ret.pivot(index="cohort_period", columns="period_index", values="retention").fillna(0.0)
-	# Make JSON-serializable labels
-	pivot.index = pivot.index.astype(str)
-	pivot.columns = pivot.columns.astype(int)
-	return pivot
 
+# Matrices returned by build_cohorts, besides the cohort sizes
+COHORT_METRICS = {
+	"retention": "Retention",
+	"events_per_user": "Events per user",
+	"cumulative_conversion": "Cumulative conversion",
+}
 
-def plot_retention(pivot: pd.DataFrame):
+
+def _empty_cohorts() -> dict[str, pd.DataFrame | pd.Series]:
+	tables = {metric: pd.DataFrame() for metric in COHORT_METRICS}
+	tables["size"] = pd.Series(dtype=np.int64, name="size")
+	return tables
+
+
+def build_cohorts(events: pd.DataFrame | EventStore, cohort_event: str = "signup", outcome_event: str = "purchase", period: str | int = "weekly") -> dict[str, pd.DataFrame | pd.Series]:
+	# Cohort tables by period offset, from one join: users are grouped by the
+	# period of their first cohort_event, and each matrix cell is a cohort's
+	# outcome_event activity k periods later (period is daily, weekly,
+	# monthly or a number of days):
+	#   retention: share of the cohort with an outcome in period k
+	#   events_per_user: outcomes in period k per cohort member
+	#   cumulative_conversion: share with a first outcome by period k
+	# plus "size", users per cohort. Matrices share rows (cohorts) and
+	# columns (offsets), those with any outcome
+	events = as_event_store(events)
+	user_id, event_time = np.asarray(events.user_id), np.asarray(events.event_time)
+	# Rows are time-ordered, so a user's first row is their first event
+	cohort_rows = events.rows(cohort_event)
+	users, first = np.unique(user_id[cohort_rows], return_index=True)
+	outcome_rows = events.rows(outcome_event)
+	if not len(users) or not len(outcome_rows):
+		return _empty_cohorts()
+	cohort_time = event_time[cohort_rows[first]]
+	anchor_day = int(cohort_time.min() // DAY_NS)
+	cohort_code = period_codes(cohort_time, period, anchor_day)
+
+	# Outcomes joined to their user's cohort by binary search
+	user = np.searchsorted(users, user_id[outcome_rows])
+	found = user < len(users)
+	found[found] = users[user[found]] == user_id[outcome_rows][found]
+	user = user[found]
+	offset = period_codes(event_time[outcome_rows][found], period, anchor_day) - cohort_code[user]
+	user, offset = user[offset >= 0], offset[offset >= 0]
+	if not len(user):
+		return _empty_cohorts()
+
+	# Everything is counted per (cohort, offset) cell with bincount: events
+	# directly, distinct users over deduped (user, offset) pairs, first
+	# outcomes over each user's first pair (pairs are sorted by user)
+	first_code = cohort_code.min()
+	n_cohorts, n_offsets = int(cohort_code.max() - first_code) + 1, int(offset.max()) + 1
+	n_cells = n_cohorts * n_offsets
+	cohort = cohort_code - first_code
+	outcomes = np.bincount(cohort[user] * n_offsets + offset, minlength=n_cells).reshape(n_cohorts, n_offsets)
+	pairs = np.unique(user * n_offsets + offset)
+	pair_user, pair_offset = pairs // n_offsets, pairs % n_offsets
+	pair_cells = cohort[pair_user] * n_offsets + pair_offset
+	converted = np.bincount(pair_cells, minlength=n_cells).reshape(n_cohorts, n_offsets)
+	first_pair = np.ones(len(pairs), dtype=bool)
+	first_pair[1:] = pair_user[1:] != pair_user[:-1]
+	first_converted = np.bincount(pair_cells[first_pair], minlength=n_cells).reshape(n_cohorts, n_offsets)
+	sizes = np.bincount(cohort, minlength=n_cohorts)
+	per_member = 1 / np.maximum(sizes, 1)[:, None]
+	matrices = {
+		"retention": converted * per_member,
+		"events_per_user": outcomes * per_member,
+		"cumulative_conversion": np.cumsum(first_converted, axis=1) * per_member,
+	}
+
+	# Only cohorts and offsets with any outcome, as labelled periods
+	rows = np.flatnonzero(converted.any(axis=1))
+	columns = np.flatnonzero(converted.any(axis=0))
+	index = pd.Index(period_labels(rows + first_code, period, anchor_day), name="cohort_period")
+	tables = {}
+	for metric, matrix in matrices.items():
+		tables[metric] = pd.DataFrame(matrix[np.ix_(rows, columns)], index=index, columns=pd.Index(columns, name="period_index"))
+	tables["size"] = pd.Series(sizes[rows], index=index, name="size")
+	return tables
+
+
+def stack_cohorts(tables: dict[str, pd.DataFrame | pd.Series]) -> pd.DataFrame:
+	# All cohort tables in long form, one row per (cohort, offset) cell, e.g.
+	# for CSV export
+	columns = ["cohort_period", "period_index", *COHORT_METRICS, "size"]
+	if tables["retention"].empty:
+		return pd.DataFrame(columns=columns)
+	long = pd.concat({metric: tables[metric].stack() for metric in COHORT_METRICS}, axis=1).reset_index()
+	long["size"] = tables["size"].reindex(long["cohort_period"]).to_numpy()
+	return long[columns]
+
+
+def plot_retention(pivot: pd.DataFrame, label: str = "Retention"):
 	if pivot is None or pivot.empty:
-		return px.imshow([[0.0]], labels=dict(color="Retention"), title="No data for selected filters")
-	fig = px.imshow(pivot, color_continuous_scale="Blues", aspect="auto", origin="lower", labels=dict(color="Retention"))
+		return px.imshow([[0.0]], labels=dict(color=label), title="No data for selected filters")
+	fig = px.imshow(pivot, color_continuous_scale="Blues", aspect="auto", origin="lower", labels=dict(color=label))
 	fig.update_layout(height=500, margin=dict(l=10, r=10, t=10, b=10))
 	return fig
@@ -1,29 +1,304 @@
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+from src.data.segments import SegmentIndex
+from src.data.store import EventStore, as_event_store
+from src.utils.cache import LRUCache
 
+# Time-to-convert histogram buckets, in seconds: [0, 1 min), then four per
+# doubling up to ~91 days (each about 19% wide); longer times land in the last
+TTC_EDGES = np.concatenate([[0.0], 60 * 2 ** (np.arange(4 * 17 + 1) / 4)])
+TTC_QUANTILES = (0.5, 0.9, 0.99)
 
-def build_funnel(events: pd.DataFrame, steps: list[str], window: pd.Timedelta) -> pd.DataFrame:
-	# Consider users who hit the first step, then compute stepwise completion
-	if not steps:
-		return pd.DataFrame(columns=["step", "users"])
-	first = steps[0]
-	first_hits = events[events["event_name"] == first][["user_id", "event_time"]].rename(columns={"event_time": "t0"})
-	funnel = []
-	eligible = first_hits.copy()
-	for idx, step in enumerate(steps):
-		if idx == 0:
-			funnel.append({"step": step, "users": eligible["user_id"].nunique()})
-			continue
-		eh = events[events["event_name"] == step][["user_id", "event_time"]]
-		joined = eligible.merge(eh, on="user_id")
-		joined = joined[(joined["event_time"] >= joined["t0"]) & (joined["event_time"] <= joined["t0"] + window)]
-		completed_users = joined.groupby("user_id")["event_time"].min().reset_index().rename(columns={"event_time": f"t{idx}"})
-		eligible = eligible.merge(completed_users, on="user_id", how="inner")
-		funnel.append({"step": step, "users": eligible["user_id"].nunique()})
-	return pd.DataFrame(funnel)
+
+class FunnelEngine:
+	# Ordered funnels over one store's CSR per-user sequences (time-ordered
+	# within each user). A user reaches step k if some step-0 event at t0 is
+	# followed, in order, by steps 1..k, each within window of t0.
+	#
+	# The state of a step prefix is the rows that advance a user to its last
+	# step, ascending, with the latest t0 reaching them: later starts leave
+	# the most room, so they dominate, and they never decrease along a user's
+	# rows. Extending a prefix by one step only touches that step's events:
+	# each looks up the latest state row before it by binary search.
+	#
+	# Events with equal timestamps have no stored order that means anything,
+	# so within a tie group they are taken in funnel order: by the first step
+	# their event appears at, then by row. A step may thus use a tied event
+	# of an earlier-appearing step, but never the same event twice. States
+	# are shared along the trie within a batch and, given a cache, kept in it
+	# per (key, window, prefix), along with their step histograms, so reruns
+	# against the same view reuse them
+
+	def __init__(self, events: EventStore, cache: LRUCache | None = None, key: tuple = ()):
+		self.catalog = events.catalog
+		self.cache = cache
+		self.key = key
+		u_ids, offsets, codes, times = events.sequences()
+		n = len(codes)
+		# Row and user positions fit int32 below 2**31 events
+		index = np.int32 if n < np.iinfo(np.int32).max else np.int64
+		self.user_ids = u_ids
+		self.times = times
+		self.offsets = offsets
+		self.user_pos = np.repeat(np.arange(len(u_ids), dtype=index), np.diff(offsets))
+		# First and last row of each row's tie group
+		group_end = np.ones(n, dtype=bool)
+		group_end[:-1] = (times[1:] != times[:-1]) | (self.user_pos[1:] != self.user_pos[:-1])
+		self.tie_end = np.flatnonzero(group_end).astype(index)[np.cumsum(group_end) - group_end]
+		group_start = np.r_[True, group_end[:-1]] if n else group_end
+		self.tie_start = np.flatnonzero(group_start).astype(index)[np.cumsum(group_start) - 1]
+		# Rows of each code, ascending (stable sort keeps sequence order)
+		self._code_rows = np.argsort(codes, kind="stable").astype(index)
+		self._code_offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(self.catalog)))])
+		# Distinct timestamps, to rank times for (user, time rank) search keys,
+		# and those keys in _code_rows order: ascending within each code
+		self._time_values, time_rank = np.unique(times, return_inverse=True)
+		self._code_keys = (self.user_pos.astype(np.int64) * (len(self._time_values) + 1) + time_rank)[self._code_rows]
+
+	@property
+	def nbytes(self) -> int:
+		arrays = [self.user_ids, self.times, self.offsets, self.user_pos, self.tie_start, self.tie_end, self._code_rows, self._code_offsets, self._time_values, self._code_keys]
+		return sum(a.nbytes for a in arrays)
+
+	def step_rows(self, code: int) -> np.ndarray:
+		if code < 0:
+			return self._code_rows[:0]
+		return self._code_rows[self._code_offsets[code]:self._code_offsets[code + 1]]
+
+	def state(self, step_codes: tuple[int, ...], window_ns: int, parent: tuple[np.ndarray, np.ndarray] | None = None) -> tuple[np.ndarray, np.ndarray]:
+		# (rows, starts) of a step prefix; parent, when given, is the state of
+		# step_codes[:-1]
+		key = ("funnel_prefix", self.key, window_ns, step_codes)
+		cached = self.cache.get(key) if self.cache is not None else None
+		if cached is not None:
+			return cached
+		rows = self.step_rows(step_codes[-1])
+		if len(step_codes) == 1:
+			state = (rows, self.times[rows])
+		else:
+			if parent is None:
+				parent = self.state(step_codes[:-1], window_ns)
+			# Funnel order of the previous step's event vs this one's
+			first_step = [step_codes.index(c) for c in step_codes[-2:]]
+			state = self._advance(parent, rows, int(np.sign(first_step[1] - first_step[0])), window_ns)
+		if self.cache is not None:
+			self.cache.put(key, state)
+		return state
+
+	def _advance(self, parent: tuple[np.ndarray, np.ndarray], rows: np.ndarray, order: int, window_ns: int) -> tuple[np.ndarray, np.ndarray]:
+		prev_rows, prev_starts = parent
+		# Latest parent row before each step row, same user. Parent rows tied
+		# with it come first if their event comes first in the funnel
+		# (order 1), only at earlier rows if it is the same event (0), and
+		# never if it comes later (-1)
+		if order > 0:
+			look = self.tie_end[rows]
+		elif order == 0:
+			look = rows - 1
+		else:
+			look = self.tie_start[rows] - 1
+		idx = np.searchsorted(prev_rows, look, side="right") - 1
+		ok = idx >= 0
+		ok[ok] = prev_rows[idx[ok]] >= self.offsets[self.user_pos[rows[ok]]]
+		rows, starts = rows[ok], prev_starts[idx[ok]]
+		within = self.times[rows] <= starts + window_ns
+		return rows[within], starts[within]
+
+	def earliest_starts(self, rows: np.ndarray, first_code: int, window_ns: int) -> np.ndarray:
+		# Earliest t0 that reaches each row of a later step's state. Every
+		# first-step event of the user from t - window up to the row's
+		# (latest) start reaches it, so this is the first of them at or after
+		# t - window: a binary search over first-step rows keyed by (user,
+		# time rank)
+		first_rows = self.step_rows(first_code)
+		keys = self._code_keys[self._code_offsets[first_code]:self._code_offsets[first_code + 1]]
+		radix = len(self._time_values) + 1
+		lower = np.searchsorted(self._time_values, self.times[rows] - window_ns)
+		found = np.searchsorted(keys, self.user_pos[rows].astype(np.int64) * radix + lower)
+		return self.times[first_rows[found]]
+
+	def histogram(self, state: tuple[np.ndarray, np.ndarray], first_code: int | None = None, window_ns: int = 0, groups: np.ndarray | None = None, n_groups: int = 1) -> np.ndarray:
+		# Users reaching a step by time to convert, as (n_groups, buckets)
+		# counts of TTC_EDGES (groups is a code per user). A user counts once,
+		# at their first advancing row (users own contiguous row ranges), timed
+		# from the earliest first-step event that reaches it; first_code is
+		# None for the first step itself. Row sums are the step's users
+		rows, starts = state
+		user_pos = self.user_pos[rows]
+		first = np.ones(len(rows), dtype=bool)
+		first[1:] = user_pos[1:] != user_pos[:-1]
+		rows = rows[first]
+		starts = starts[first] if first_code is None else self.earliest_starts(rows, first_code, window_ns)
+		seconds = (self.times[rows] - starts) / 1e9
+		bucket = np.minimum(np.searchsorted(TTC_EDGES, seconds, side="right") - 1, len(TTC_EDGES) - 2)
+		group = np.zeros(len(bucket), dtype=np.int64) if groups is None else groups[user_pos[first]]
+		n_buckets = len(TTC_EDGES) - 1
+		return np.bincount(group * n_buckets + bucket, minlength=n_groups * n_buckets).reshape(n_groups, n_buckets)
+
+
+def histogram_quantiles(counts: np.ndarray, quantiles=TTC_QUANTILES) -> np.ndarray:
+	# Quantiles (seconds) per row of TTC_EDGES bucket counts, interpolated
+	# linearly within the bucket; NaN for empty rows
+	counts = np.atleast_2d(counts)
+	cum = np.cumsum(counts, axis=1)
+	total = cum[:, -1:]
+	result = np.full((len(counts), len(quantiles)), np.nan)
+	for j, q in enumerate(quantiles):
+		target = q * total
+		bucket = np.minimum((cum < target).sum(axis=1), counts.shape[1] - 1)
+		below = np.take_along_axis(cum, bucket[:, None], axis=1) - np.take_along_axis(counts, bucket[:, None], axis=1)
+		inside = np.take_along_axis(counts, bucket[:, None], axis=1)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			frac = np.clip(np.where(inside > 0, (target - below) / inside, 0.0), 0.0, 1.0)[:, 0]
+		value = TTC_EDGES[bucket] + frac * (TTC_EDGES[bucket + 1] - TTC_EDGES[bucket])
+		result[:, j] = np.where(total[:, 0] > 0, value, np.nan)
+	return result
+
+
+def funnel_engine(events: EventStore, cache: LRUCache | None = None, key: tuple = ()) -> FunnelEngine:
+	# With a cache, the engine and its prefix states are kept in it under
+	# key (which must identify the events), so they count against its budget
+	# and survive reruns; without one, each call builds its own
+	if cache is None:
+		return FunnelEngine(events)
+	engine = cache.get(("funnel_engine", key))
+	if engine is None:
+		engine = FunnelEngine(events, cache, key)
+		cache.put(("funnel_engine", key), engine, engine.nbytes)
+	return engine
+
+
+def _as_engine(events: "pd.DataFrame | EventStore | FunnelEngine", cache: LRUCache | None, cache_key: tuple) -> FunnelEngine:
+	if isinstance(events, FunnelEngine):
+		return events
+	return funnel_engine(as_event_store(events), cache, cache_key)
+
+
+def _walk(engine: FunnelEngine, funnels: list[list[str]], window: pd.Timedelta, groups: np.ndarray | None, n_groups: int, group_key: str | None = None) -> dict[tuple[str, ...], np.ndarray]:
+	# Step histograms of every prefix of the funnels, walked as a trie so
+	# each shared prefix is computed once. Cached histograms (per group_key,
+	# the breakdown) skip their state; children then fetch it on demand
+	trie: dict = {}
+	for steps in funnels:
+		node = trie
+		for step in steps:
+			node = node.setdefault(step, {})
+	histograms = {}
+	pending = [((), None, trie)]
+	while pending:
+		prefix, parent, node = pending.pop()
+		for step, child in node.items():
+			steps = prefix + (step,)
+			step_codes = tuple(int(c) for c in engine.catalog.codes(list(steps)))
+			key = ("funnel_histogram", engine.key, window.value, step_codes, group_key)
+			counts = engine.cache.get(key) if engine.cache is not None else None
+			state = None
+			if counts is None:
+				state = engine.state(step_codes, window.value, parent)
+				first_code = None if len(steps) == 1 else step_codes[0]
+				counts = engine.histogram(state, first_code, window.value, groups, n_groups)
+				if engine.cache is not None:
+					engine.cache.put(key, counts)
+			histograms[steps] = counts
+			pending.append((steps, state, child))
+	return histograms
+
+
+def _breakdown_groups(engine: FunnelEngine, segments: SegmentIndex | None, breakdown: str | None) -> tuple[np.ndarray | None, list[str]]:
+	if breakdown is None:
+		return None, ["all"]
+	return segments.attribute_codes(breakdown, engine.user_ids), segments.values(breakdown) + ["unknown"]
+
+
+def build_funnels(events: pd.DataFrame | EventStore | FunnelEngine, funnels: list[list[str]], window: pd.Timedelta, segments: SegmentIndex | None = None, breakdown: str | None = None, timing: bool = False, cache: LRUCache | None = None, cache_key: tuple = ()) -> list[pd.DataFrame] | list[tuple[pd.DataFrame, pd.DataFrame]]:
+	# Many funnel definitions at once, sharing prefix work. With breakdown (a
+	# user attribute of segments), step counts come per attribute value from
+	# the same pass, in long form with the attribute as first column. With
+	# timing, p50/p90/p99 time to convert (hours from the first step) are
+	# added from the same per-step histograms, and each funnel comes as a
+	# (frame, time_to_convert table) pair. cache and cache_key keep the
+	# prefix states for later calls (see funnel_engine); events may also be
+	# an engine from funnel_engine, whose own cache and key then apply
+	engine = _as_engine(events, cache, cache_key)
+	groups, labels = _breakdown_groups(engine, segments, breakdown)
+	histograms = _walk(engine, funnels, window, groups, len(labels), breakdown)
+
+	columns = ["step", "users"] if breakdown is None else [breakdown, "step", "users"]
+	if timing:
+		columns += [f"p{round(q * 100)}_hours" for q in TTC_QUANTILES]
+	n_buckets = len(TTC_EDGES) - 1
+	frames = []
+	for steps in funnels:
+		# (steps, groups, buckets) -> rows grouped by label, then step
+		counts = np.array([histograms[tuple(steps[:k + 1])] for k in range(len(steps))]).reshape(len(steps), len(labels), n_buckets)
+		counts = counts.transpose(1, 0, 2).reshape(len(steps) * len(labels), n_buckets)
+		frame = pd.DataFrame({"step": np.tile(steps, len(labels)), "users": counts.sum(axis=1)}, columns=["step", "users"])
+		if timing:
+			hours = np.empty((0, len(TTC_QUANTILES)))
+			if steps:
+				hours = histogram_quantiles(counts) / 3600
+				# The first step is its own start
+				hours[::len(steps)] = np.where(np.isnan(hours[::len(steps)]), np.nan, 0.0)
+			for j, column in enumerate(columns[-len(TTC_QUANTILES):]):
+				frame[column] = hours[:, j]
+		if breakdown is not None:
+			frame.insert(0, breakdown, np.repeat(labels, len(steps)))
+			# Values nobody in the data has, e.g. an empty unknown slot, are noise
+			frame = frame[frame.groupby(breakdown, sort=False)["users"].transform("max") > 0].reset_index(drop=True)
+		frames.append((frame[columns], _ttc_frame(histograms, steps)) if timing else frame[columns])
+	return frames
+
+
+def build_funnel(events: pd.DataFrame | EventStore | FunnelEngine, steps: list[str], window: pd.Timedelta, segments: SegmentIndex | None = None, breakdown: str | None = None, timing: bool = False, cache: LRUCache | None = None, cache_key: tuple = ()) -> pd.DataFrame | tuple[pd.DataFrame, pd.DataFrame]:
+	return build_funnels(events, [steps], window, segments, breakdown, timing, cache, cache_key)[0]
+
+
+def time_to_convert(events: pd.DataFrame | EventStore | FunnelEngine, steps: list[str], window: pd.Timedelta, cache: LRUCache | None = None, cache_key: tuple = ()) -> pd.DataFrame:
+	# Per-step time-to-convert histograms (hours from the first step) in long
+	# form, non-empty buckets only. build_funnel(..., timing=True) returns
+	# the same table alongside the funnel
+	engine = _as_engine(events, cache, cache_key)
+	return _ttc_frame(_walk(engine, [steps], window, None, 1), steps)
+
+
+def _ttc_frame(histograms: dict[tuple[str, ...], np.ndarray], steps: list[str]) -> pd.DataFrame:
+	# Long-form table of _walk histograms, summed over groups
+	frames = []
+	for k in range(1, len(steps)):
+		counts = histograms[tuple(steps[:k + 1])].sum(axis=0)
+		nonzero = np.flatnonzero(counts)
+		frames.append(pd.DataFrame({
+			"step": steps[k],
+			"from_hours": TTC_EDGES[nonzero] / 3600,
+			"to_hours": TTC_EDGES[nonzero + 1] / 3600,
+			"users": counts[nonzero],
+		}))
+	if not frames:
+		return pd.DataFrame(columns=["step", "from_hours", "to_hours", "users"])
+	return pd.concat(frames, ignore_index=True)
 
 
 def plot_funnel(funnel_df: pd.DataFrame):
 	fig = go.Figure(go.Funnel(y=funnel_df["step"], x=funnel_df["users"]))
 	fig.update_layout(height=400, margin=dict(l=10, r=10, t=10, b=10))
 	return fig
+
+
+def plot_funnel_breakdown(funnel_df: pd.DataFrame, breakdown: str):
+	fig = go.Figure()
+	for value, group in funnel_df.groupby(breakdown, sort=False):
+		fig.add_trace(go.Funnel(name=str(value), y=group["step"], x=group["users"], textinfo="value+percent initial"))
+	fig.update_layout(height=450, margin=dict(l=10, r=10, t=10, b=10), legend_title_text=breakdown)
+	return fig
+
+
+def plot_time_to_convert(ttc_df: pd.DataFrame):
+	# Buckets are equally wide on a log time axis; each is drawn at its
+	# geometric midpoint (the first, from 0, at 30 seconds)
+	fig = go.Figure()
+	for step, group in ttc_df.groupby("step", sort=False):
+		midpoint = np.sqrt(group["from_hours"].clip(lower=1 / 120) * group["to_hours"])
+		fig.add_trace(go.Scatter(name=str(step), x=midpoint, y=group["users"], mode="lines+markers", line_shape="spline"))
+	fig.update_layout(height=400, margin=dict(l=10, r=10, t=10, b=10), xaxis_type="log", xaxis_title="Hours since first step", yaxis_title="Users")
+	return fig
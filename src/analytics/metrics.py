@@ -1,39 +1,174 @@
+import numpy as np
 import pandas as pd
+import plotly.express as px
+from src.data.store import EventStore, as_event_store
 
+DAY_NS = 86_400_000_000_000
 
-def compute_kpis(users: pd.DataFrame, events: pd.DataFrame, start: pd.Timestamp, end: pd.Timestamp) -> dict:
-	frame = events[(events["event_time"] >= start) & (events["event_time"] < end)].copy()
-	frame["date"] = frame["event_time"].dt.date
-
-	# Active users
-	daily_active = frame.groupby("date")["user_id"].nunique()
-	wau = frame.copy()
-	wau["week"] = wau["event_time"].dt.isocalendar().week
-	weekly_active = wau.groupby("week")["user_id"].nunique()
-	mau = frame.copy()
-	mau["month"] = mau["event_time"].dt.to_period("M")
-	monthly_active = mau.groupby("month")["user_id"].nunique()
-
-	# Conversion (signup -> purchase within window)
-	signups = frame[frame["event_name"] == "signup"]["user_id"].unique()
-	purchasers = frame[frame["event_name"] == "purchase"]["user_id"].unique()
-	conversion = 0.0 if len(signups) == 0 else len(set(purchasers) & set(signups)) / len(signups)
-
-	# Simple retention snapshot: next-week activity after signup
-	signup_events = events[events["event_name"] == "signup"].copy()
-	signup_events["week"] = signup_events["event_time"].dt.isocalendar().week
-	future = events.copy()
-	future["week"] = future["event_time"].dt.isocalendar().week
-	ret = (
-		future.merge(signup_events[["user_id", "week"]], on="user_id", suffixes=("", "_signup"))
-		.assign(retained=lambda d: (d["week"] >= d["week_signup"] + 1) & (d["week"] <= d["week_signup"] + 4))
-		.groupby("week_signup")["retained"].mean().reset_index().rename(columns={"week_signup": "cohort_week", "retained": "retention"})
-	)
 
+def period_keys(times: np.ndarray) -> dict[str, np.ndarray]:
+	# Integer day/week/month numbers since the epoch. Weeks start on Monday
+	# (1970-01-01 was a Thursday) and, unlike ISO week numbers, never repeat
+	# across years
+	day = times // DAY_NS
 	return {
-		"dau_avg": float(daily_active.mean()) if not daily_active.empty else 0.0,
-		"wau_avg": float(weekly_active.mean()) if not weekly_active.empty else 0.0,
-		"mau_avg": float(monthly_active.mean()) if not monthly_active.empty else 0.0,
+		"day": day,
+		"week": (day + 3) // 7,
+		"month": times.view("datetime64[ns]").astype("datetime64[M]").astype(np.int64),
+	}
+
+
+def _distinct_per_bucket(keys: np.ndarray, user_start: np.ndarray) -> np.ndarray:
+	# Rows are grouped by user and time-ordered within a user, so a bucket key
+	# never decreases inside a user: each (user, bucket) pair starts exactly
+	# where the user or the key changes. Returns counts of non-empty buckets
+	first = user_start.copy()
+	first[1:] |= keys[1:] != keys[:-1]
+	counts = np.bincount(keys[first] - keys.min())
+	return counts[counts > 0]
+
+
+def user_conversion(user_pos: np.ndarray, is_from: np.ndarray, is_to: np.ndarray, n_users: int) -> float:
+	# Share of users with a from-row that also have a to-row (any order)
+	converted_from = np.zeros(n_users, dtype=bool)
+	converted_from[user_pos[is_from]] = True
+	converted_to = np.zeros(n_users, dtype=bool)
+	converted_to[user_pos[is_to]] = True
+	return 0.0 if not converted_from.any() else float((converted_from & converted_to).sum() / converted_from.sum())
+
+
+def compute_kpis(users: pd.DataFrame, events: pd.DataFrame | EventStore, start: pd.Timestamp, end: pd.Timestamp, sketches=None, selections: dict[str, list[str]] | None = None, rollup=None) -> dict:
+	# rollup (a DailyRollup over the unfiltered events) answers every KPI for
+	# the range and segment selections without scanning events. sketches (a
+	# DailySketches) swaps active-user counts for HyperLogLog estimates
+	active = {"day": np.empty(0), "week": np.empty(0), "month": np.empty(0)}
+	if rollup is not None:
+		active = {name: rollup.actives(name, start, end, selections)[1] for name in active}
+		conversion = rollup.conversion("signup", "purchase", start, end, selections)
+		retention = rollup.retention(start, end, selections)
+	else:
+		events = as_event_store(events)
+		window = events.between(start, end)
+		u_ids, offsets, order = window.user_index()
+		user_start = np.zeros(len(window), dtype=bool)
+		user_start[offsets[:-1]] = True
+
+		# Active users: one (user, time) ordering shared by every granularity
+		if len(window):
+			for name, keys in period_keys(np.asarray(window.event_time)[order]).items():
+				active[name] = _distinct_per_bucket(keys, user_start)
+
+		# Conversion (signup -> purchase within window)
+		user_pos = np.repeat(np.arange(len(u_ids)), np.diff(offsets))
+		codes = np.asarray(window.event_code)[order]
+		conversion = user_conversion(user_pos, codes == window.catalog.code("signup"), codes == window.catalog.code("purchase"), len(u_ids))
+		retention = retention_snapshot(events)
+	if sketches is not None:
+		active = {name: sketches.actives(name, start, end, selections)[1] for name in active}
+
+	return {
+		"dau_avg": float(active["day"].mean()) if len(active["day"]) else 0.0,
+		"wau_avg": float(active["week"].mean()) if len(active["week"]) else 0.0,
+		"mau_avg": float(active["month"].mean()) if len(active["month"]) else 0.0,
 		"conversion_rate": float(conversion),
-		"retention": ret,
+		"retention": retention,
 	}
+
+
+def retention_snapshot(events: pd.DataFrame | EventStore, min_weeks: int = 1, max_weeks: int = 4) -> pd.DataFrame:
+	# Share of each signup-week cohort active again 1-4 weeks after signing up,
+	# per user on the CSR index, so cost is linear in events
+	events = as_event_store(events)
+	u_ids, offsets, order = events.user_index()
+	user_pos = np.repeat(np.arange(len(u_ids)), np.diff(offsets))
+	weeks = period_keys(np.asarray(events.event_time)[order])["week"]
+	signup = np.asarray(events.event_code)[order] == events.catalog.code("signup")
+	return retention_by_week(user_pos, weeks, signup, len(u_ids), min_weeks, max_weeks)
+
+
+def retention_by_week(user_pos: np.ndarray, weeks: np.ndarray, signup: np.ndarray, n_users: int, min_weeks: int = 1, max_weeks: int = 4) -> pd.DataFrame:
+	# Rows grouped by user and time-ordered within each user: first signup
+	# week per user, then the user's distinct active weeks
+	empty = pd.DataFrame({"cohort_week": pd.Series(dtype="datetime64[ns]"), "retention": pd.Series(dtype=float)})
+	signup_rows = np.flatnonzero(signup)
+	signup_users, first = np.unique(user_pos[signup_rows], return_index=True)
+	if not len(signup_users):
+		return empty
+	signup_week = np.full(n_users, -1, dtype=np.int64)
+	signup_week[signup_users] = weeks[signup_rows[first]]
+
+	# Compact (user, active week) pairs: a pair starts where the user or week changes
+	pair = np.ones(len(weeks), dtype=bool)
+	pair[1:] = (user_pos[1:] != user_pos[:-1]) | (weeks[1:] != weeks[:-1])
+	pair_users, pair_weeks = user_pos[pair], weeks[pair]
+	lag = pair_weeks - signup_week[pair_users]
+	hit = (signup_week[pair_users] >= 0) & (lag >= min_weeks) & (lag <= max_weeks)
+	retained = np.zeros(n_users, dtype=bool)
+	retained[pair_users[hit]] = True
+
+	cohorts, cohort_idx = np.unique(signup_week[signup_users], return_inverse=True)
+	rate = np.bincount(cohort_idx, weights=retained[signup_users]) / np.bincount(cohort_idx)
+	# Week w starts on Monday, day 7w - 3 (1970-01-01 was a Thursday)
+	starts = ((cohorts * 7 - 3) * DAY_NS).view("datetime64[ns]")
+	return pd.DataFrame({"cohort_week": starts, "retention": rate})
+
+
+def trailing_actives(user_pos: np.ndarray, days: np.ndarray, first_day: int, n_days: int, window: int) -> np.ndarray:
+	# Distinct users active in the trailing `window` days, for each of
+	# n_days days from first_day, by difference counting. Input is distinct
+	# (user, day) pairs grouped by user with days ascending. A user is
+	# covered from each active day until `window` days later or their next
+	# active day, whichever is first, so coverage never overlaps: +1 where it
+	# starts, -1 where it stops, and a cumulative sum gives every day at once
+	next_day = np.full(len(days), np.iinfo(np.int64).max)
+	same_user = user_pos[1:] == user_pos[:-1]
+	next_day[:-1][same_user] = days[1:][same_user]
+	begin = np.maximum(days, first_day) - first_day
+	stop = np.minimum(np.minimum(days + window, next_day), first_day + n_days) - first_day
+	valid = stop > begin
+	delta = np.bincount(begin[valid], minlength=n_days + 1) - np.bincount(stop[valid], minlength=n_days + 1)
+	return np.cumsum(delta)[:n_days]
+
+
+def rolling_active_users(events: pd.DataFrame | EventStore, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None, windows: tuple[int, ...] = (7, 28), rollup=None, selections: dict[str, list[str]] | None = None) -> pd.DataFrame:
+	# Daily series of DAU, trailing-N-day actives and stickiness (DAU / N-day
+	# actives) for each day in [start, end) in one sweep. With a rollup (a
+	# DailyRollup over the unfiltered events) the trailing windows also see
+	# activity before start; from events they only see the events given
+	if rollup is not None:
+		lookback = pd.Timedelta(days=max(windows) - 1)
+		user_pos, days = rollup.activity_pairs(None if start is None else start - lookback, end, selections)
+	else:
+		events = as_event_store(events).between(start, end)
+		u_ids, offsets, order = events.user_index()
+		user_pos = np.repeat(np.arange(len(u_ids)), np.diff(offsets))
+		days = np.asarray(events.event_time)[order] // DAY_NS
+		pair = np.ones(len(days), dtype=bool)
+		pair[1:] = (user_pos[1:] != user_pos[:-1]) | (days[1:] != days[:-1])
+		user_pos, days = user_pos[pair], days[pair]
+	if not len(days):
+		return pd.DataFrame(columns=["date", "dau"] + [f"{kind}_{w}d" for w in windows for kind in ("active", "stickiness")])
+
+	first_day = days.min() if start is None else max(pd.Timestamp(start).value // DAY_NS, days.min())
+	last_day = days.max() + 1 if end is None else min(-(-pd.Timestamp(end).value // DAY_NS), days.max() + 1)
+	n_days = int(last_day - first_day)
+	dau = trailing_actives(user_pos, days, first_day, n_days, 1)
+	result = pd.DataFrame({"date": ((first_day + np.arange(n_days)) * DAY_NS).view("datetime64[ns]"), "dau": dau})
+	for window in windows:
+		active = trailing_actives(user_pos, days, first_day, n_days, window)
+		result[f"active_{window}d"] = active
+		result[f"stickiness_{window}d"] = np.divide(dau, active, out=np.zeros(n_days), where=active > 0)
+	return result
+
+
+def plot_rolling_actives(rolling: pd.DataFrame):
+	active_cols = ["dau"] + [c for c in rolling.columns if c.startswith("active_")]
+	fig = px.line(rolling, x="date", y=active_cols, labels={"value": "Active users", "variable": ""})
+	fig.update_layout(height=400, margin=dict(l=10, r=10, t=10, b=10))
+	return fig
+
+
+def plot_stickiness(rolling: pd.DataFrame):
+	fig = px.line(rolling, x="date", y=[c for c in rolling.columns if c.startswith("stickiness_")], labels={"value": "DAU / N-day actives", "variable": ""})
+	fig.update_layout(height=300, margin=dict(l=10, r=10, t=10, b=10), yaxis_tickformat=".0%")
+	return fig
@@ -0,0 +1,294 @@
+import numpy as np
+import pandas as pd
+from src.analytics.metrics import DAY_NS, period_keys, retention_by_week, user_conversion
+from src.data.catalog import EventCatalog
+from src.data.segments import SegmentIndex
+from src.data.store import EventStore, as_event_store
+
+# Cube rows with this code count any event, i.e. active users
+ANY_EVENT = -1
+PERIODS = ("week", "month")
+_NO_LIMIT = np.iinfo(np.int64).max // 4
+
+
+def _day_bounds(start: pd.Timestamp | None, end: pd.Timestamp | None) -> tuple[int, int]:
+	# [start, end) as whole days; None leaves that side open
+	lo = -_NO_LIMIT if start is None else pd.Timestamp(start).value // DAY_NS
+	hi = _NO_LIMIT if end is None else -(-pd.Timestamp(end).value // DAY_NS)
+	return lo, hi
+
+
+def _bucket_days(period: str, keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+	# First day and one-past-last day of each week/month key from period_keys
+	if period == "week":
+		return keys * 7 - 3, keys * 7 + 4
+	months = keys.astype("datetime64[M]")
+	return months.astype("datetime64[D]").astype(np.int64), (months + 1).astype("datetime64[D]").astype(np.int64)
+
+
+def _group_sum(keys: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+	if not len(keys):
+		return keys.astype(np.int64), values.astype(np.int64)
+	uniq, idx = np.unique(keys, return_inverse=True)
+	return uniq, np.bincount(idx, weights=values).astype(np.int64)
+
+
+def _ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+	# Concatenated aranges [starts[i], stops[i])
+	lengths = stops - starts
+	return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+
+def _splice(arrays: dict, remove: np.ndarray, insert: dict, key: str) -> dict:
+	# Replace whole key groups of a table sorted by `key`: drop the `remove`
+	# rows, then insert the (sorted) replacement rows where their keys belong
+	kept = {name: np.delete(values, remove, axis=0) for name, values in arrays.items()}
+	pos = np.searchsorted(kept[key], insert[key])
+	return {name: np.insert(kept[name], pos, insert[name], axis=0) for name in arrays}
+
+
+class DailyRollup:
+	# Aggregates materialized per dataset, at day granularity:
+	# - cube: events and distinct users per (day, segment, event code) cell,
+	#   plus an ANY_EVENT cell per (day, segment) for active users
+	# - periods: distinct active users per (week or month, segment)
+	# - activity: one row per distinct (day, user), day-sorted, with a packed
+	#   bitmask of the event codes seen that day. It answers the exact
+	#   distincts the cube can't: partially covered weeks/months, conversion
+	#   and retention over any range
+	# Segments come from SegmentIndex and partition users, so distinct counts
+	# for a segment selection are sums over cells. Appending a batch only
+	# recomputes the batch's days, weeks and months
+
+	def __init__(self, catalog: EventCatalog, segments: SegmentIndex, user_ids: np.ndarray, user_segment: np.ndarray, cube: dict, periods: dict, activity: dict):
+		self.catalog = catalog
+		self.segments = segments
+		self.user_ids = user_ids
+		self.user_segment = user_segment
+		self.cube = cube
+		self.periods = periods
+		self.activity = activity
+		self._by_id = np.argsort(user_ids, kind="stable")
+
+	@classmethod
+	def empty(cls, segments: SegmentIndex) -> "DailyRollup":
+		none = np.empty(0, dtype=np.int64)
+		cube = {"day": none, "segment": none, "code": none, "events": none, "users": none}
+		periods = {period: {"key": none, "segment": none, "users": none} for period in PERIODS}
+		activity = {"day": none, "user": none.astype(np.int32), "codes": np.empty((0, 0), dtype=np.uint8)}
+		return cls(EventCatalog([]), segments, none, none, cube, periods, activity)
+
+	@classmethod
+	def build(cls, events: pd.DataFrame | EventStore, segments: SegmentIndex) -> "DailyRollup":
+		return cls.empty(segments).append(events, segments)
+
+	@property
+	def nbytes(self) -> int:
+		parts = [*self.cube.values(), *self.activity.values(), self.user_ids, self.user_segment, self._by_id]
+		parts += [a for period in self.periods.values() for a in period.values()]
+		return sum(a.nbytes for a in parts)
+
+	def _user_positions(self, user_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+		# Positions of user_ids (sorted unique) in self.user_ids, and the ids not seen yet
+		pos = np.searchsorted(self.user_ids, user_ids, sorter=self._by_id)
+		found = pos < len(self._by_id)
+		found[found] = self.user_ids[self._by_id[pos[found]]] == user_ids[found]
+		positions = np.full(len(user_ids), -1, dtype=np.int64)
+		positions[found] = self._by_id[pos[found]]
+		return positions, user_ids[~found]
+
+	def _cell_keys(self, day: np.ndarray, segment: np.ndarray, code: np.ndarray | int) -> np.ndarray:
+		n_slots = len(self.catalog) + 1
+		return (day * self.segments.n_segments + segment) * n_slots + (code + 1)
+
+	def _user_cells(self, activity: dict) -> tuple[np.ndarray, np.ndarray]:
+		# Distinct users per cube cell: one per (activity row, code bit), plus
+		# one per row for ANY_EVENT
+		rows, codes = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+		for byte in range(activity["codes"].shape[1]):
+			r, bit = np.nonzero(np.unpackbits(activity["codes"][:, byte:byte + 1], axis=1))
+			rows.append(r)
+			codes.append(byte * 8 + bit)
+		rows, codes = np.concatenate(rows), np.concatenate(codes)
+		segment = self.user_segment[activity["user"]]
+		keys = np.concatenate([self._cell_keys(activity["day"][rows], segment[rows], codes), self._cell_keys(activity["day"], segment, ANY_EVENT)])
+		return np.unique(keys, return_counts=True)
+
+	def _period_cells(self, period: str, activity: dict) -> dict:
+		keys = period_keys(activity["day"] * DAY_NS)[period]
+		n_users, n_segments = len(self.user_ids), self.segments.n_segments
+		pairs = np.unique(keys * n_users + activity["user"])
+		cells, counts = np.unique((pairs // n_users) * n_segments + self.user_segment[pairs % n_users], return_counts=True)
+		return {"key": cells // n_segments, "segment": cells % n_segments, "users": counts}
+
+	def append(self, batch: pd.DataFrame | EventStore, segments: SegmentIndex) -> "DailyRollup":
+		# A new rollup with a batch of events (appended to the dataset this
+		# rollup describes) folded in. Only the batch's days, weeks and months
+		# are recomputed; other rows are carried over. segments must cover the
+		# batch's users and keep this rollup's segment layout
+		batch = as_event_store(batch)
+		if not len(batch):
+			return self
+		if self.segments.layout() != segments.layout():
+			raise ValueError("Segment values changed; rebuild the rollup instead of appending")
+		# Events stored without a name have a code past the catalog; they have
+		# no code bit or cube cell to land in, so they are left out
+		named = np.asarray(batch.event_code) < len(batch.catalog)
+		if not named.all():
+			batch = batch.take(np.flatnonzero(named))
+			if not len(batch):
+				return self
+
+		# Catalog and users only ever grow, so existing codes and positions hold
+		new_names = [n for n in batch.catalog.names if n not in self.catalog]
+		catalog = EventCatalog(self.catalog.names + new_names) if new_names else self.catalog
+		b_ids, b_offsets, b_order = batch.user_index()
+		positions, new_ids = self._user_positions(b_ids)
+		positions[positions < 0] = len(self.user_ids) + np.arange(len(new_ids))
+		user_ids = np.concatenate([self.user_ids, new_ids])
+		user_segment = np.concatenate([self.user_segment, segments.segment_codes(new_ids)])
+		rollup = DailyRollup(catalog, segments, user_ids, user_segment, self.cube, self.periods, self.activity)
+
+		# Batch rows are user-grouped and time-ordered: its (day, user) pairs
+		# start where the user or day changes
+		user = np.repeat(positions, np.diff(b_offsets))
+		day = np.asarray(batch.event_time)[b_order] // DAY_NS
+		code = catalog.codes(batch.catalog.names)[np.asarray(batch.event_code)[b_order]]
+		width = (len(catalog) + 7) // 8
+		starts = np.ones(len(day), dtype=bool)
+		starts[1:] = (user[1:] != user[:-1]) | (day[1:] != day[:-1])
+		codes = np.zeros((int(starts.sum()), width), dtype=np.uint8)
+		np.bitwise_or.at(codes, (np.cumsum(starts) - 1, code >> 3), (128 >> (code & 7)).astype(np.uint8))
+
+		# Activity: merge the batch pairs into the affected days' rows
+		activity = self.activity
+		if activity["codes"].shape[1] < width:
+			activity = {**activity, "codes": np.pad(activity["codes"], ((0, 0), (0, width - activity["codes"].shape[1])))}
+		days = np.unique(day)
+		old_rows = _ranges(np.searchsorted(activity["day"], days), np.searchsorted(activity["day"], days, side="right"))
+		pairs = {
+			"day": np.concatenate([activity["day"][old_rows], day[starts]]),
+			"user": np.concatenate([activity["user"][old_rows], user[starts].astype(np.int32)]),
+			"codes": np.concatenate([activity["codes"][old_rows], codes]),
+		}
+		order = np.lexsort((pairs["user"], pairs["day"]))
+		pairs = {name: values[order] for name, values in pairs.items()}
+		first = np.flatnonzero(np.r_[True, (pairs["day"][1:] != pairs["day"][:-1]) | (pairs["user"][1:] != pairs["user"][:-1])])
+		merged = {"day": pairs["day"][first], "user": pairs["user"][first], "codes": np.bitwise_or.reduceat(pairs["codes"], first, axis=0)}
+		rollup.activity = _splice(activity, old_rows, merged, "day")
+
+		# Cube: event counts add up; distinct users are recounted from the
+		# affected days' merged activity
+		old_cells = _ranges(np.searchsorted(self.cube["day"], days), np.searchsorted(self.cube["day"], days, side="right"))
+		segment = user_segment[user]
+		event_keys = np.concatenate([
+			rollup._cell_keys(self.cube["day"][old_cells], self.cube["segment"][old_cells], self.cube["code"][old_cells]),
+			rollup._cell_keys(day, segment, code),
+			rollup._cell_keys(day, segment, ANY_EVENT),
+		])
+		weights = np.concatenate([self.cube["events"][old_cells], np.ones(2 * len(day), dtype=np.int64)])
+		cells, n_events = _group_sum(event_keys, weights)
+		_, n_users = rollup._user_cells(merged)
+		n_slots, n_segments = len(catalog) + 1, segments.n_segments
+		rest = cells // n_slots
+		rollup.cube = _splice(self.cube, old_cells, {
+			"day": rest // n_segments,
+			"segment": rest % n_segments,
+			"code": cells % n_slots - 1,
+			"events": n_events,
+			"users": n_users,
+		}, "day")
+
+		# Periods: recount the affected weeks/months over their full day spans
+		rollup.periods = {}
+		for period in PERIODS:
+			keys = np.unique(period_keys(days * DAY_NS)[period])
+			first_day, last_day = _bucket_days(period, keys)
+			span = rollup.activity["day"]
+			rows = _ranges(np.searchsorted(span, first_day), np.searchsorted(span, last_day))
+			cells = rollup._period_cells(period, {name: values[rows] for name, values in rollup.activity.items()})
+			old = self.periods[period]
+			old_rows = _ranges(np.searchsorted(old["key"], keys), np.searchsorted(old["key"], keys, side="right"))
+			rollup.periods[period] = _splice(old, old_rows, cells, "key")
+		return rollup
+
+	def _activity_rows(self, lo: int, hi: int, mask: np.ndarray | None) -> np.ndarray:
+		a, b = np.searchsorted(self.activity["day"], [lo, hi])
+		rows = np.arange(a, b)
+		return rows if mask is None else rows[mask[self.user_segment[self.activity["user"][rows]]]]
+
+	def _has_code(self, rows: np.ndarray, name: str) -> np.ndarray:
+		code = self.catalog.code(name)
+		if code < 0:
+			return np.zeros(len(rows), dtype=bool)
+		return (self.activity["codes"][rows, code >> 3] & (128 >> (code & 7))) != 0
+
+	def daily(self, event_name: str | None = None, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None, selections: dict[str, list[str]] | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+		# Per non-empty day in [start, end): day numbers, distinct users and
+		# event counts, for one event or (None) any event
+		code = ANY_EVENT if event_name is None else self.catalog.code(event_name)
+		if event_name is not None and code < 0:
+			empty = np.empty(0, dtype=np.int64)
+			return empty, empty, empty
+		lo, hi = _day_bounds(start, end)
+		a, b = np.searchsorted(self.cube["day"], [lo, hi])
+		rows = np.arange(a, b)
+		keep = self.cube["code"][rows] == code
+		mask = self.segments.segment_mask(selections or {})
+		if mask is not None:
+			keep &= mask[self.cube["segment"][rows]]
+		rows = rows[keep]
+		days, users = _group_sum(self.cube["day"][rows], self.cube["users"][rows])
+		_, n_events = _group_sum(self.cube["day"][rows], self.cube["events"][rows])
+		return days, users, n_events
+
+	def actives(self, period: str = "day", start: pd.Timestamp | None = None, end: pd.Timestamp | None = None, selections: dict[str, list[str]] | None = None) -> tuple[np.ndarray, np.ndarray]:
+		# Exact distinct users per non-empty day/week/month bucket in
+		# [start, end), keyed as in period_keys
+		if period == "day":
+			return self.daily(None, start, end, selections)[:2]
+		lo, hi = _day_bounds(start, end)
+		mask = self.segments.segment_mask(selections or {})
+		cube = self.periods[period]
+		first, last = _bucket_days(period, cube["key"])
+		keep = (first >= lo) & (last <= hi)
+		if mask is not None:
+			keep &= mask[cube["segment"]]
+		keys, counts = _group_sum(cube["key"][keep], cube["users"][keep])
+
+		# Buckets cut by the range edges are counted from the activity rows
+		edge_keys, edge_counts = [], []
+		for day, is_open in ((lo, start is None), (hi - 1, end is None)):
+			key = int(period_keys(np.array([day * DAY_NS]))[period][0]) if not is_open else None
+			if key is None or key in edge_keys:
+				continue
+			b_first, b_last = (int(d[0]) for d in _bucket_days(period, np.array([key])))
+			if b_first >= lo and b_last <= hi:
+				continue
+			rows = self._activity_rows(max(b_first, lo), min(b_last, hi), mask)
+			edge_keys.append(key)
+			edge_counts.append(len(np.unique(self.activity["user"][rows])))
+		keys = np.concatenate([keys, np.array(edge_keys, dtype=np.int64)])
+		counts = np.concatenate([counts, np.array(edge_counts, dtype=np.int64)])
+		order = np.argsort(keys)
+		keys, counts = keys[order], counts[order]
+		return keys[counts > 0], counts[counts > 0]
+
+	def conversion(self, from_event: str, to_event: str, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None, selections: dict[str, list[str]] | None = None) -> float:
+		# Share of users with from_event in [start, end) who also have to_event there
+		rows = self._activity_rows(*_day_bounds(start, end), self.segments.segment_mask(selections or {}))
+		return user_conversion(self.activity["user"][rows], self._has_code(rows, from_event), self._has_code(rows, to_event), len(self.user_ids))
+
+	def activity_pairs(self, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None, selections: dict[str, list[str]] | None = None) -> tuple[np.ndarray, np.ndarray]:
+		# Distinct (user, day) pairs in [start, end), grouped by user with
+		# days ascending; the stable sort keeps the day order
+		rows = self._activity_rows(*_day_bounds(start, end), self.segments.segment_mask(selections or {}))
+		rows = rows[np.argsort(self.activity["user"][rows], kind="stable")]
+		return self.activity["user"][rows], self.activity["day"][rows]
+
+	def retention(self, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None, selections: dict[str, list[str]] | None = None) -> pd.DataFrame:
+		rows = self._activity_rows(*_day_bounds(start, end), self.segments.segment_mask(selections or {}))
+		# Day-sorted rows regrouped by user; the stable sort keeps days in order
+		rows = rows[np.argsort(self.activity["user"][rows], kind="stable")]
+		weeks = (self.activity["day"][rows] + 3) // 7
+		return retention_by_week(self.activity["user"][rows], weeks, self._has_code(rows, "signup"), len(self.user_ids))
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+from src.analytics.metrics import DAY_NS, period_keys
+from src.data.segments import SegmentIndex
+from src.data.store import EventStore, as_event_store
+
+DEFAULT_ERROR = 0.02
+# 2^14 one-byte registers (16 KB) per (day, segment) cell, ±0.8%; more would
+# not fit a state cache budget for multi-year data
+MIN_PRECISION, MAX_PRECISION = 4, 14
+
+
+def precision_for_error(error: float) -> int:
+	# HLL standard error is about 1.04 / sqrt(2^p)
+	p = int(np.ceil(np.log2((1.04 / error) ** 2)))
+	return min(max(p, MIN_PRECISION), MAX_PRECISION)
+
+
+def _hash64(values: np.ndarray) -> np.ndarray:
+	# splitmix64 finalizer; uint64 arithmetic wraps, which is what we want
+	x = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+	return x ^ (x >> np.uint64(31))
+
+
+def _register_updates(user_ids: np.ndarray, precision: int) -> tuple[np.ndarray, np.ndarray]:
+	h = _hash64(user_ids)
+	index = (h >> np.uint64(64 - precision)).astype(np.intp)
+	# Rank = position of the first set bit in the low 32 bits (33 if none).
+	# frexp is exact here since 32-bit values fit a double's mantissa
+	low = (h & np.uint64(0xFFFFFFFF)).astype(np.float64)
+	rank = (33 - np.frexp(low)[1]).astype(np.uint8)
+	return index, rank
+
+
+def estimate(registers: np.ndarray) -> np.ndarray:
+	# Cardinality per row of an (n, m) register array, with linear counting
+	# for small ranges
+	m = registers.shape[-1]
+	alpha = 0.7213 / (1 + 1.079 / m)
+	raw = alpha * m * m / np.ldexp(1.0, -registers.astype(np.int64)).sum(axis=-1)
+	zeros = (registers == 0).sum(axis=-1)
+	with np.errstate(divide="ignore"):
+		linear = m * np.log(m / np.maximum(zeros, 1))
+	return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class DailySketches:
+	# One HyperLogLog sketch of active users per (day, segment) cell, with
+	# segments as defined by SegmentIndex. Any date range, granularity and
+	# segment selection is answered by merging cells (register-wise max)
+	# instead of rescanning events. Only non-empty cells are stored, sorted
+	# by (day, segment)
+
+	def __init__(self, days: np.ndarray, segment: np.ndarray, registers: np.ndarray, precision: int, segments: SegmentIndex):
+		self.days = days
+		self.segment = segment
+		self.registers = registers
+		self.precision = precision
+		self.segments = segments
+
+	@classmethod
+	def build(cls, events: pd.DataFrame | EventStore, segments: SegmentIndex, error: float = DEFAULT_ERROR) -> "DailySketches":
+		precision = precision_for_error(error)
+		none = np.empty(0, dtype=np.int64)
+		empty = cls(none, none, np.empty((0, 1 << precision), dtype=np.uint8), precision, segments)
+		return empty.append(events, segments)
+
+	def append(self, batch: pd.DataFrame | EventStore, segments: SegmentIndex) -> "DailySketches":
+		# New sketches with a batch of appended events added: only the batch's
+		# (day, segment) cells change, created as needed
+		batch = as_event_store(batch)
+		if not len(batch):
+			return self
+		if self.segments.layout() != segments.layout():
+			raise ValueError("Segment values changed; rebuild the sketches instead of appending")
+		u_ids, offsets, order = batch.user_index()
+		user_segment = segments.segment_codes(u_ids)
+
+		# Distinct (user, day) pairs first, so each user updates a cell once
+		user_pos = np.repeat(np.arange(len(u_ids)), np.diff(offsets))
+		day = np.asarray(batch.event_time)[order] // DAY_NS
+		pair = np.ones(len(day), dtype=bool)
+		pair[1:] = (user_pos[1:] != user_pos[:-1]) | (day[1:] != day[:-1])
+		pair_users, pair_days = user_pos[pair], day[pair]
+
+		n_segments = segments.n_segments
+		cell_keys = pair_days * n_segments + user_segment[pair_users]
+		existing = self.days * n_segments + self.segment
+		new_cells = np.setdiff1d(cell_keys, existing)
+		pos = np.searchsorted(existing, new_cells)
+		keys = np.insert(existing, pos, new_cells)
+		registers = np.insert(self.registers, pos, 0, axis=0)
+		index, rank = _register_updates(u_ids[pair_users], self.precision)
+		np.maximum.at(registers, (np.searchsorted(keys, cell_keys), index), rank)
+		return DailySketches(keys // n_segments, keys % n_segments, registers, self.precision, segments)
+
+	@property
+	def relative_error(self) -> float:
+		return 1.04 / np.sqrt(1 << self.precision)
+
+	@property
+	def nbytes(self) -> int:
+		return self.registers.nbytes + self.days.nbytes + self.segment.nbytes
+
+	def _cells(self, start: pd.Timestamp | None, end: pd.Timestamp | None, selections: dict[str, list[str]] | None) -> np.ndarray:
+		lo = 0 if start is None else np.searchsorted(self.days, pd.Timestamp(start).value // DAY_NS)
+		hi = len(self.days) if end is None else np.searchsorted(self.days, -(-pd.Timestamp(end).value // DAY_NS))
+		cells = np.arange(lo, hi)
+		mask = self.segments.segment_mask(selections or {})
+		return cells if mask is None else cells[mask[self.segment[cells]]]
+
+	def actives(self, period: str = "day", start: pd.Timestamp | None = None, end: pd.Timestamp | None = None, selections: dict[str, list[str]] | None = None) -> tuple[np.ndarray, np.ndarray]:
+		# Estimated distinct users per non-empty day/week/month bucket in
+		# [start, end). Returns the bucket keys (as in period_keys) and estimates
+		cells = self._cells(start, end, selections)
+		if not len(cells):
+			return np.empty(0, dtype=np.int64), np.empty(0)
+		keys = period_keys(self.days[cells] * DAY_NS)[period]
+		starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+		merged = np.maximum.reduceat(self.registers[cells], starts, axis=0)
+		return keys[starts], estimate(merged)
@@ -0,0 +1,23 @@
+import numpy as np
+
+
+class EventCatalog:
+	# Event name <-> small integer code dictionary shared by an EventStore and
+	# the analytics that query it, so event selection never compares strings
+
+	def __init__(self, names: list[str]):
+		self.names = [str(n) for n in names]
+		self._codes = {name: code for code, name in enumerate(self.names)}
+
+	def __len__(self) -> int:
+		return len(self.names)
+
+	def __contains__(self, name: str) -> bool:
+		return name in self._codes
+
+	def code(self, name: str) -> int:
+		# -1 never matches a stored code, so unknown events select nothing
+		return self._codes.get(name, -1)
+
+	def codes(self, names: list[str]) -> np.ndarray:
+		return np.array([self.code(n) for n in names], dtype=np.int64)
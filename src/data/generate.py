@@ -2,11 +2,23 @@ import numpy as np
 import pandas as pd
 from numpy.random import default_rng
 import datetime as dt
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 rng = default_rng(42)
 
+DEFAULT_SEED = 42
+DEFAULT_SHARD_SIZE = 25_000
+# Engagement offsets are |N(7, 10)| days, so users older than this almost
+# never produce new events and are skipped by top-ups
+TOPUP_LOOKBACK_DAYS = 60
+ONE_OFF_EVENTS = ("signup", "activate", "purchase")
 
-def generate_users(num_users: int = 50000, start: str | pd.Timestamp | None = None, end: str | pd.Timestamp | None = None) -> pd.DataFrame:
+HOUR_NS = 3_600_000_000_000
+DAY_NS = 24 * HOUR_NS
+
+
+def _window_seconds(start: str | pd.Timestamp | None, end: str | pd.Timestamp | None) -> tuple[int, int]:
 	# Default to rolling last 180 days ending today
 	if end is None:
 		end_dt = pd.Timestamp.today().normalize()
@@ -16,71 +28,175 @@ def generate_users(num_users: int = 50000, start: str | pd.Timestamp | None = No
 		start_dt = end_dt - pd.Timedelta(days=180)
 	else:
 		start_dt = pd.Timestamp(start)
-
-	# Sample signup times uniformly over the window
 	start_s = int(start_dt.timestamp())
 	end_s = int((end_dt + pd.Timedelta(days=1)).timestamp())  # inclusive end day
-	join_dates = pd.to_datetime(rng.integers(start_s, end_s, size=num_users), unit="s")
-	channels = rng.choice(["organic", "paid", "referral", "seo"], size=num_users, p=[0.45, 0.35, 0.10, 0.10])
-	country = rng.choice(["US", "IN", "BR", "DE", "GB", "CA"], size=num_users, p=[0.35, 0.25, 0.15, 0.10, 0.10, 0.05])
+	return start_s, end_s
+
+
+def _sample_users(num_users: int, start_s: int, end_s: int, first_user_id: int = 1, gen: np.random.Generator | None = None) -> pd.DataFrame:
+	gen = rng if gen is None else gen
+	# Sample signup times uniformly over the window
+	join_dates = pd.to_datetime(gen.integers(start_s, end_s, size=num_users), unit="s")
+	channels = gen.choice(["organic", "paid", "referral", "seo"], size=num_users, p=[0.45, 0.35, 0.10, 0.10])
+	country = gen.choice(["US", "IN", "BR", "DE", "GB", "CA"], size=num_users, p=[0.35, 0.25, 0.15, 0.10, 0.10, 0.05])
 	return pd.DataFrame({
-		"user_id": np.arange(1, num_users + 1),
+		"user_id": np.arange(first_user_id, first_user_id + num_users),
 		"signup_time": join_dates.sort_values().values,
 		"acq_channel": channels,
 		"country": country,
 	})
 
 
-def simulate_events(users: pd.DataFrame, end: pd.Timestamp | None = None) -> pd.DataFrame:
+def generate_users(num_users: int = 50000, start: str | pd.Timestamp | None = None, end: str | pd.Timestamp | None = None) -> pd.DataFrame:
+	start_s, end_s = _window_seconds(start, end)
+	return _sample_users(num_users, start_s, end_s)
+
+
+def _signup_ns(users: pd.DataFrame) -> np.ndarray:
+	signup = pd.to_datetime(users["signup_time"])
+	if signup.dt.tz is not None:
+		signup = signup.dt.tz_localize(None)
+	return signup.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+
+def simulate_events(users: pd.DataFrame, end: pd.Timestamp | None = None, gen: np.random.Generator | None = None) -> pd.DataFrame:
+	gen = rng if gen is None else gen
 	if end is None:
 		end = pd.Timestamp.today().normalize() + pd.Timedelta(days=1)
-	events = []
-	for _, u in users.iterrows():
-		# view probability by channel/country
-		base_view = 0.6 if u["acq_channel"] in ("organic", "seo") else 0.5
-		base_view *= 1.1 if u["country"] in ("US", "DE", "GB") else 0.9
-		signup_time = pd.to_datetime(u["signup_time"]).tz_localize(None)
-		if signup_time >= end:
-			continue
-		if rng.random() < base_view:
-			pre_time = signup_time - pd.Timedelta(hours=int(rng.integers(1, 72)))
-			if pre_time < end:
-				events.append((u.user_id, "view", pre_time))
-
-		activate_prob = 0.55 if u["acq_channel"] != "paid" else 0.45
-		activate_prob *= 1.1 if u["country"] in ("US", "DE", "GB") else 0.95
-		if rng.random() < activate_prob:
-			activate_time = signup_time + pd.Timedelta(days=int(abs(rng.normal(1.5, 2))))
-			if activate_time < end:
-				events.append((u.user_id, "activate", activate_time))
-				purchase_prob = 0.28 if u["acq_channel"] in ("organic", "referral") else 0.22
-				purchase_prob *= 1.15 if u["country"] in ("US", "GB") else 0.9
-				if rng.random() < purchase_prob:
-					purchase_time = activate_time + pd.Timedelta(days=int(abs(rng.normal(3.0, 4))))
-					if purchase_time < end:
-						events.append((u.user_id, "purchase", purchase_time))
-
-		# engagement events across weeks
-		n_days = int(rng.integers(1, 30))
-		for _ in range(n_days):
-			if rng.random() < base_view * 0.7:
-				delta = pd.Timedelta(days=int(abs(rng.normal(7, 10))))
-				eng_time = signup_time + delta
-				if eng_time < end:
-					events.append((u.user_id, "view", eng_time))
-
-	# add explicit signup events
-	for _, u in users.iterrows():
-		st = pd.to_datetime(u["signup_time"]).tz_localize(None)
-		if st < end:
-			events.append((u.user_id, "signup", st))
-
-	events_df = pd.DataFrame(events, columns=["user_id", "event_name", "event_time"]).sort_values("event_time").reset_index(drop=True)
-	return events_df
-
-
-def generate_datasets() -> tuple[pd.DataFrame, pd.DataFrame]:
-	end_dt = pd.Timestamp.today().normalize()
-	users = generate_users(end=end_dt)
-	events = simulate_events(users, end=end_dt + pd.Timedelta(days=1))
+	end_ns = pd.Timestamp(end).value
+	signup_ns = _signup_ns(users)
+	keep = signup_ns < end_ns
+	user_id = users["user_id"].to_numpy()[keep]
+	signup_ns = signup_ns[keep]
+	channel = users["acq_channel"].to_numpy()[keep]
+	country = users["country"].to_numpy()[keep]
+	n = len(user_id)
+
+	# view probability by channel/country
+	strong_country = np.isin(country, ["US", "DE", "GB"])
+	base_view = np.where(np.isin(channel, ["organic", "seo"]), 0.6, 0.5)
+	base_view *= np.where(strong_country, 1.1, 0.9)
+	viewed = gen.random(n) < base_view
+	pre_ns = signup_ns[viewed] - gen.integers(1, 72, size=int(viewed.sum())) * HOUR_NS
+
+	activate_prob = np.where(channel != "paid", 0.55, 0.45)
+	activate_prob *= np.where(strong_country, 1.1, 0.95)
+	activate_ns = signup_ns + np.abs(gen.normal(1.5, 2, size=n)).astype(np.int64) * DAY_NS
+	activated = (gen.random(n) < activate_prob) & (activate_ns < end_ns)
+
+	purchase_prob = np.where(np.isin(channel, ["organic", "referral"]), 0.28, 0.22)
+	purchase_prob *= np.where(np.isin(country, ["US", "GB"]), 1.15, 0.9)
+	purchase_ns = activate_ns + np.abs(gen.normal(3.0, 4, size=n)).astype(np.int64) * DAY_NS
+	purchased = activated & (gen.random(n) < purchase_prob) & (purchase_ns < end_ns)
+
+	# engagement events across weeks
+	n_days = gen.integers(1, 30, size=n)
+	owner = np.repeat(np.arange(n), n_days)
+	engage_ns = signup_ns[owner] + np.abs(gen.normal(7, 10, size=len(owner))).astype(np.int64) * DAY_NS
+	engaged = (gen.random(len(owner)) < base_view[owner] * 0.7) & (engage_ns < end_ns)
+	owner = owner[engaged]
+
+	parts = [
+		(user_id[viewed], "view", pre_ns),
+		(user_id[activated], "activate", activate_ns[activated]),
+		(user_id[purchased], "purchase", purchase_ns[purchased]),
+		(user_id[owner], "view", engage_ns[engaged]),
+		(user_id, "signup", signup_ns),
+	]
+	event_time = np.concatenate([p[2] for p in parts])
+	order = np.argsort(event_time, kind="stable")
+	return pd.DataFrame({
+		"user_id": np.concatenate([p[0] for p in parts])[order],
+		"event_name": np.concatenate([np.full(len(p[0]), p[1], dtype=object) for p in parts])[order],
+		"event_time": event_time[order].astype("datetime64[ns]"),
+	})
+
+
+def _shard_rng(seed: int, shard: int) -> np.random.Generator:
+	# Same child stream SeedSequence(seed).spawn(n)[shard] would hand out
+	return default_rng(np.random.SeedSequence(seed, spawn_key=(shard,)))
+
+
+def generate_shard(shard: int, num_users: int, shard_size: int = DEFAULT_SHARD_SIZE, seed: int = DEFAULT_SEED, start: str | pd.Timestamp | None = None, end: str | pd.Timestamp | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+	# A shard owns a contiguous user_id range and the matching proportional
+	# slice of the signup window, so shards are independent of each other
+	end_dt = pd.Timestamp.today().normalize() if end is None else pd.Timestamp(end)
+	start_s, end_s = _window_seconds(start, end_dt)
+	span = end_s - start_s
+	first = shard * shard_size
+	last = min(first + shard_size, num_users)
+	lo = start_s + span * first // num_users
+	hi = start_s + span * last // num_users
+	gen = _shard_rng(seed, shard)
+	users = _sample_users(last - first, lo, max(hi, lo + 1), first_user_id=first + 1, gen=gen)
+	events = simulate_events(users, end=end_dt + pd.Timedelta(days=1), gen=gen)
+	return users, events
+
+
+def _generate_shard_args(args: tuple) -> tuple[pd.DataFrame, pd.DataFrame]:
+	return generate_shard(*args)
+
+
+def iter_shards(num_users: int, shard_size: int = DEFAULT_SHARD_SIZE, seed: int = DEFAULT_SEED, start: str | pd.Timestamp | None = None, end: str | pd.Timestamp | None = None, workers: int = 1):
+	# Yields (users, events) per shard in user_id order. With workers > 1 at
+	# most 2 * workers shards are in flight, so memory stays bounded
+	end_dt = pd.Timestamp.today().normalize() if end is None else pd.Timestamp(end)
+	jobs = [(i, num_users, shard_size, seed, start, end_dt) for i in range(-(-num_users // shard_size))]
+	if workers <= 1:
+		for job in jobs:
+			yield generate_shard(*job)
+		return
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		pending = deque()
+		for job in jobs:
+			pending.append(pool.submit(_generate_shard_args, job))
+			if len(pending) >= 2 * workers:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def generate_datasets(num_users: int = 50000, workers: int = 1, seed: int = DEFAULT_SEED, shard_size: int = DEFAULT_SHARD_SIZE, end: str | pd.Timestamp | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+	# Output depends only on (num_users, seed, shard_size, end), never on workers
+	shards = list(iter_shards(num_users, shard_size, seed, end=end, workers=workers))
+	users = pd.concat([u for u, _ in shards], ignore_index=True)
+	events = pd.concat([e for _, e in shards], ignore_index=True)
+	events = events.sort_values("event_time", kind="stable", ignore_index=True)
 	return users, events
+
+
+def simulate_topup(users: pd.DataFrame, events: pd.DataFrame, end: str | pd.Timestamp | None = None, seed: int = DEFAULT_SEED) -> tuple[pd.DataFrame, pd.DataFrame]:
+	# Only simulate the days after the last event's day, for new signups and
+	# for existing users recent enough to still be generating events
+	end_dt = pd.Timestamp.today().normalize() if end is None else pd.Timestamp(end).normalize()
+	cutoff = pd.Timestamp(events["event_time"].max()).normalize() + pd.Timedelta(days=1)
+	if cutoff > end_dt:
+		return users.iloc[:0], events.iloc[:0]
+	gen = default_rng(np.random.SeedSequence(seed, spawn_key=(1, cutoff.value // DAY_NS)))
+
+	signup = pd.to_datetime(users["signup_time"])
+	days_seen = max(1, (cutoff - signup.min().normalize()).days)
+	gap_days = (end_dt - cutoff).days + 1
+	num_new = int(gen.poisson(len(users) / days_seen * gap_days))
+	start_s = int(cutoff.timestamp())
+	end_s = int((end_dt + pd.Timedelta(days=1)).timestamp())
+	new_users = _sample_users(num_new, start_s, end_s, first_user_id=int(users["user_id"].max()) + 1, gen=gen)
+
+	recent = users[signup >= cutoff - pd.Timedelta(days=TOPUP_LOOKBACK_DAYS)]
+	new_events = simulate_events(pd.concat([recent, new_users], ignore_index=True), end=end_dt + pd.Timedelta(days=1), gen=gen)
+	new_events = new_events[new_events["event_time"] >= cutoff]
+
+	# Re-simulated users must not repeat a one-off event they already have
+	had = events[events["event_name"].isin(ONE_OFF_EVENTS) & events["user_id"].isin(recent["user_id"])]
+	had = had[["user_id", "event_name"]].drop_duplicates()
+	new_events = new_events.merge(had, on=["user_id", "event_name"], how="left", indicator=True)
+	new_events = new_events[new_events["_merge"] == "left_only"].drop(columns="_merge")
+
+	# A re-simulated activate before the cutoff is dropped while the purchase
+	# it led to may not be; purchases need an activate on either side
+	activated = pd.concat([
+		events.loc[(events["event_name"] == "activate") & events["user_id"].isin(recent["user_id"]), "user_id"],
+		new_events.loc[new_events["event_name"] == "activate", "user_id"],
+	])
+	orphan = (new_events["event_name"] == "purchase") & ~new_events["user_id"].isin(activated)
+	return new_users, new_events[~orphan].reset_index(drop=True)
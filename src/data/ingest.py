@@ -0,0 +1,137 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from src.data.store import EventStore, _narrow_int
+
+USER_COLUMNS = ["user_id", "signup_time", "acq_channel", "country"]
+EVENT_COLUMNS = ["user_id", "event_name", "event_time"]
+DEFAULT_CHUNK_ROWS = 500_000
+# Keep the report small enough to show; the totals still count every bad row
+MAX_REPORTED_ERRORS = 1000
+
+
+def file_digest(fileobj) -> str:
+	digest = hashlib.blake2b(digest_size=16)
+	fileobj.seek(0)
+	for block in iter(lambda: fileobj.read(1 << 20), b""):
+		digest.update(block)
+	fileobj.seek(0)
+	return digest.hexdigest()
+
+
+def _read_chunks(fileobj, columns: list[str], chunk_rows: int):
+	# Everything is read as strings and typed after validation, so a bad
+	# value becomes a reported row instead of a failed parse
+	fileobj.seek(0)
+	header = pd.read_csv(fileobj, nrows=0).columns
+	missing = [c for c in columns if c not in header]
+	if missing:
+		raise ValueError(f"Missing columns: {', '.join(missing)}")
+	fileobj.seek(0)
+	return pd.read_csv(fileobj, usecols=columns, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+
+
+class _ErrorReport:
+	def __init__(self):
+		self.frames = []
+		self.reported = 0
+		self.total = 0
+
+	def add(self, chunk: pd.DataFrame, bad: np.ndarray, column: str, error: str) -> None:
+		count = int(bad.sum())
+		if not count:
+			return
+		self.total += count
+		room = MAX_REPORTED_ERRORS - self.reported
+		if room > 0:
+			rows = chunk[bad].head(room)
+			# +2: 1-based lines plus the header line
+			self.frames.append(pd.DataFrame({"line": rows.index + 2, "column": column, "value": rows[column], "error": error}))
+			self.reported += len(rows)
+
+	def frame(self) -> pd.DataFrame:
+		if not self.frames:
+			return pd.DataFrame(columns=["line", "column", "value", "error"])
+		return pd.concat(self.frames, ignore_index=True).sort_values("line", kind="stable", ignore_index=True)
+
+
+def _parse_ids(chunk: pd.DataFrame, report: _ErrorReport) -> tuple[np.ndarray, np.ndarray]:
+	ids = pd.to_numeric(chunk["user_id"], errors="coerce")
+	bad = ids.isna().to_numpy() | (ids.to_numpy() % 1 != 0)
+	report.add(chunk, bad, "user_id", "not an integer id")
+	return ids.to_numpy(), bad
+
+
+def _parse_times(chunk: pd.DataFrame, column: str, report: _ErrorReport) -> tuple[np.ndarray, np.ndarray]:
+	# Parsed as UTC so mixed offsets (DST) and naive values share one dtype;
+	# naive values are taken as UTC
+	times = pd.to_datetime(chunk[column], utc=True, errors="coerce")
+	# The fast path infers one format from the chunk; only rows that don't
+	# fit it pay for per-value parsing
+	retry = times.isna() & (chunk[column].str.strip() != "")
+	if retry.any():
+		times = times.copy()
+		times[retry] = pd.to_datetime(chunk.loc[retry, column], utc=True, errors="coerce", format="mixed")
+	times = times.dt.tz_convert(None)
+	bad = times.isna().to_numpy()
+	report.add(chunk, bad, column, "unparseable timestamp")
+	return times.to_numpy(dtype="datetime64[ns]").view(np.int64), bad
+
+
+def _parse_labels(chunk: pd.DataFrame, column: str, report: _ErrorReport) -> np.ndarray:
+	bad = (chunk[column].str.strip() == "").to_numpy()
+	report.add(chunk, bad, column, "empty value")
+	return bad
+
+
+def ingest_events_csv(fileobj, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> tuple[EventStore, pd.DataFrame, int]:
+	# Parse in chunks straight into the compact store arrays (13 bytes/row),
+	# then dedupe and time-sort once. Returns the store, the row-level error
+	# report and the total number of invalid values found
+	report = _ErrorReport()
+	names: dict[str, int] = {}
+	user_ids, codes, times = [], [], []
+	for chunk in _read_chunks(fileobj, EVENT_COLUMNS, chunk_rows):
+		ids, bad_id = _parse_ids(chunk, report)
+		ts, bad_time = _parse_times(chunk, "event_time", report)
+		bad_name = _parse_labels(chunk, "event_name", report)
+		ok = ~(bad_id | bad_time | bad_name)
+		chunk_names, chunk_codes = np.unique(chunk["event_name"].to_numpy()[ok].astype(str), return_inverse=True)
+		remap = np.array([names.setdefault(n.strip(), len(names)) for n in chunk_names], dtype=np.int64)
+		user_ids.append(ids[ok].astype(np.int64))
+		codes.append(remap[chunk_codes])
+		times.append(ts[ok])
+	if len(names) >= np.iinfo(np.uint8).max:
+		raise ValueError(f"Too many distinct event names: {len(names)}")
+
+	user_id = np.concatenate(user_ids) if user_ids else np.empty(0, dtype=np.int64)
+	code = np.concatenate(codes) if codes else np.empty(0, dtype=np.int64)
+	time = np.concatenate(times) if times else np.empty(0, dtype=np.int64)
+	order = np.lexsort((code, user_id, time))
+	user_id, code, time = user_id[order], code[order], time[order]
+	dup = np.zeros(len(time), dtype=bool)
+	dup[1:] = (time[1:] == time[:-1]) & (user_id[1:] == user_id[:-1]) & (code[1:] == code[:-1])
+	keep = ~dup
+	store = EventStore(_narrow_int(user_id[keep]), code[keep].astype(np.uint8), time[keep], list(names))
+	return store, report.frame(), report.total
+
+
+def ingest_users_csv(fileobj, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> tuple[pd.DataFrame, pd.DataFrame, int]:
+	report = _ErrorReport()
+	frames = []
+	for chunk in _read_chunks(fileobj, USER_COLUMNS, chunk_rows):
+		ids, bad_id = _parse_ids(chunk, report)
+		ts, bad_time = _parse_times(chunk, "signup_time", report)
+		ok = ~(bad_id | bad_time)
+		frames.append(pd.DataFrame({
+			"user_id": ids[ok].astype(np.int64),
+			"signup_time": ts[ok].view("datetime64[ns]"),
+			"acq_channel": chunk["acq_channel"].to_numpy()[ok],
+			"country": chunk["country"].to_numpy()[ok],
+		}))
+	users = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=USER_COLUMNS)
+	users = users.sort_values("signup_time", kind="stable").drop_duplicates("user_id").sort_values("user_id", ignore_index=True)
+	users["user_id"] = _narrow_int(users["user_id"].to_numpy(dtype=np.int64))
+	for col in ["acq_channel", "country"]:
+		users[col] = users[col].replace("", np.nan).astype("category")
+	return users, report.frame(), report.total
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+SEGMENT_ATTRIBUTES = ("acq_channel", "country")
+
+
+class SegmentIndex:
+	# One packed bitmap over the users table's rows per (attribute, value),
+	# built once per dataset. Any mix of selections, multi-value included,
+	# resolves with bitwise OR within an attribute and AND across attributes
+
+	def __init__(self, users: pd.DataFrame, attributes: tuple[str, ...] = SEGMENT_ATTRIBUTES):
+		self.n_users = len(users)
+		self.user_ids = users["user_id"].to_numpy()
+		self.bitmaps: dict[str, dict[str, np.ndarray]] = {}
+		# Per-user value codes in the order of values(attr), -1 when missing
+		self.codes: dict[str, np.ndarray] = {}
+		for attr in attributes:
+			if attr not in users.columns:
+				continue
+			codes, values = pd.factorize(users[attr], sort=True)
+			self.codes[attr] = codes
+			self.bitmaps[attr] = {str(v): np.packbits(codes == i) for i, v in enumerate(values)}
+
+	def values(self, attr: str) -> list[str]:
+		return list(self.bitmaps.get(attr, {}))
+
+	def select(self, selections: dict[str, list[str]]) -> np.ndarray | None:
+		# None means no attribute was constrained, i.e. every user
+		result = None
+		for attr, chosen in selections.items():
+			if not chosen or attr not in self.bitmaps:
+				continue
+			union = np.zeros((self.n_users + 7) // 8, dtype=np.uint8)
+			for value in chosen:
+				bitmap = self.bitmaps[attr].get(str(value))
+				if bitmap is not None:
+					union |= bitmap
+			result = union if result is None else result & union
+		return result
+
+	def user_rows(self, bitmap: np.ndarray) -> np.ndarray:
+		return np.flatnonzero(np.unpackbits(bitmap, count=self.n_users))
+
+	# Segments: every combination of attribute values, plus an "unknown" slot
+	# per attribute for missing values and users absent from the table. Each
+	# user belongs to exactly one, so distinct counts add up across segments
+
+	def layout(self) -> dict[str, list[str]]:
+		# Segment codes stay valid between two indexes with the same layout
+		return {attr: self.values(attr) for attr in self.codes}
+
+	@property
+	def n_segments(self) -> int:
+		return int(np.prod([len(self.bitmaps[attr]) + 1 for attr in self.codes], dtype=np.int64))
+
+	def _user_rows(self, user_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+		# Users table rows of the given ids; found marks ids present in it
+		by_id = np.argsort(self.user_ids, kind="stable")
+		pos = np.searchsorted(self.user_ids, user_ids, sorter=by_id)
+		found = pos < len(by_id)
+		found[found] = self.user_ids[by_id[pos[found]]] == user_ids[found]
+		return found, by_id[pos[found]]
+
+	def _attribute_codes(self, attr: str, found: np.ndarray, rows: np.ndarray) -> np.ndarray:
+		unknown = len(self.bitmaps[attr])
+		attr_codes = np.full(len(found), unknown, dtype=np.int64)
+		attr_codes[found] = self.codes[attr][rows]
+		attr_codes[attr_codes < 0] = unknown
+		return attr_codes
+
+	def attribute_codes(self, attr: str, user_ids: np.ndarray) -> np.ndarray:
+		# Per-user value codes of one attribute, in the order of values(attr),
+		# with len(values(attr)) for unknown
+		return self._attribute_codes(attr, *self._user_rows(user_ids))
+
+	def segment_codes(self, user_ids: np.ndarray) -> np.ndarray:
+		found, rows = self._user_rows(user_ids)
+		segment = np.zeros(len(user_ids), dtype=np.int64)
+		for attr in self.codes:
+			segment = segment * (len(self.bitmaps[attr]) + 1) + self._attribute_codes(attr, found, rows)
+		return segment
+
+	def segment_mask(self, selections: dict[str, list[str]]) -> np.ndarray | None:
+		# select() over segment codes instead of users; None means every segment
+		result = None
+		segment = np.arange(self.n_segments)
+		stride = len(segment)
+		for attr in self.codes:
+			values = self.values(attr)
+			radix = len(values) + 1
+			stride //= radix
+			chosen = selections.get(attr)
+			if not chosen:
+				continue
+			codes = [values.index(str(v)) for v in chosen if str(v) in values]
+			hit = np.isin(segment // stride % radix, codes)
+			result = hit if result is None else result & hit
+		return result
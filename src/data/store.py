@@ -0,0 +1,352 @@
+import hashlib
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from src.data.catalog import EventCatalog
+
+SCHEMA_FILE = "schema.json"
+MANIFEST_FILE = "manifest.json"
+# Bump whenever the on-disk layout changes so stale manifests get rebuilt
+SCHEMA_VERSION = 1
+
+
+def _code_dtype(n_categories: int) -> np.dtype:
+	# The dtype's max value is reserved as the missing-value code
+	for dtype in (np.uint8, np.uint16, np.uint32):
+		if n_categories < np.iinfo(dtype).max:
+			return np.dtype(dtype)
+	raise ValueError(f"Too many categories: {n_categories}")
+
+
+def _narrow_int(values: np.ndarray) -> np.ndarray:
+	if len(values) and values.dtype.kind in "iu" and values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max:
+		return values.astype(np.int32)
+	return values
+
+
+def _encode_column(col: pd.Series) -> tuple[np.ndarray, dict]:
+	if pd.api.types.is_datetime64_any_dtype(col):
+		if col.dt.tz is not None:
+			col = col.dt.tz_localize(None)
+		return col.to_numpy(dtype="datetime64[ns]").view(np.int64), {"kind": "time"}
+	if pd.api.types.is_bool_dtype(col) or pd.api.types.is_numeric_dtype(col):
+		return _narrow_int(col.to_numpy()), {"kind": "numeric"}
+	codes, categories = pd.factorize(col, sort=True)
+	dtype = _code_dtype(len(categories))
+	codes = np.where(codes < 0, np.iinfo(dtype).max, codes).astype(dtype)
+	return codes, {"kind": "category", "categories": [str(c) for c in categories]}
+
+
+def _decode_column(values: np.ndarray, spec: dict):
+	if spec["kind"] == "time":
+		return values.view("datetime64[ns]")
+	if spec["kind"] == "category":
+		codes = values.astype(np.int32)
+		codes[values == np.iinfo(values.dtype).max] = -1
+		return pd.Categorical.from_codes(codes, categories=spec["categories"])
+	return values
+
+
+def month_partitions(times: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+	# Month partitions of a time-sorted int64 ns column: keys are months since
+	# 1970-01 and rows offsets[i]:offsets[i + 1] belong to keys[i]
+	if not len(times):
+		return np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+	first, last = np.array([times[0], times[-1]]).view("datetime64[ns]").astype("datetime64[M]").astype(np.int64)
+	keys = np.arange(first, last + 1)
+	bounds = keys[1:].astype("datetime64[M]").astype("datetime64[ns]").view(np.int64)
+	offsets = np.concatenate([[0], np.searchsorted(times, bounds, side="left"), [len(times)]])
+	return keys, offsets
+
+
+def write_table(df: pd.DataFrame, table_dir: Path, partition_by: str | None = None) -> None:
+	# One typed .npy per column: times as int64 ns, strings as dictionary codes.
+	# With partition_by the rows are kept sorted by that time column and the
+	# schema records each month's row range, so readers can map just the
+	# months they need. Written to a sibling directory first so readers never
+	# see a partial table
+	table_dir = Path(table_dir)
+	if partition_by is not None and not df[partition_by].is_monotonic_increasing:
+		df = df.sort_values(partition_by, kind="stable", ignore_index=True)
+	tmp_dir = table_dir.with_name(table_dir.name + ".tmp")
+	shutil.rmtree(tmp_dir, ignore_errors=True)
+	tmp_dir.mkdir(parents=True)
+	schema = {"rows": len(df), "columns": {}}
+	for name in df.columns:
+		values, spec = _encode_column(df[name])
+		np.save(tmp_dir / f"{name}.npy", values)
+		schema["columns"][name] = spec
+		if name == partition_by:
+			keys, offsets = month_partitions(values)
+			schema["partitions"] = {"column": name, "unit": "month", "keys": keys.tolist(), "offsets": offsets.tolist()}
+	(tmp_dir / SCHEMA_FILE).write_text(json.dumps(schema))
+	old_dir = table_dir.with_name(table_dir.name + ".old")
+	# A leftover from an interrupted write would block the rename
+	shutil.rmtree(old_dir, ignore_errors=True)
+	if table_dir.exists():
+		table_dir.rename(old_dir)
+	tmp_dir.rename(table_dir)
+	shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def read_schema(table_dir: Path) -> dict:
+	return json.loads((Path(table_dir) / SCHEMA_FILE).read_text())
+
+
+def read_table(table_dir: Path, columns: list[str] | None = None) -> pd.DataFrame:
+	table_dir = Path(table_dir)
+	schema = read_schema(table_dir)
+	names = list(schema["columns"]) if columns is None else columns
+	return pd.DataFrame({
+		name: _decode_column(np.load(table_dir / f"{name}.npy"), schema["columns"][name])
+		for name in names
+	})
+
+
+def table_exists(table_dir: Path) -> bool:
+	return (Path(table_dir) / SCHEMA_FILE).exists()
+
+
+def append_table(df: pd.DataFrame, table_dir: Path) -> None:
+	# Dictionaries may grow, so appends re-encode the table; fine for daily top-ups
+	if df.empty:
+		return
+	schema = read_schema(table_dir)
+	current = read_table(table_dir)
+	merged = pd.concat([current, df[current.columns]], ignore_index=True)
+	for name, spec in schema["columns"].items():
+		if spec["kind"] == "category":
+			merged[name] = merged[name].astype(object)
+	write_table(merged, table_dir, partition_by=schema.get("partitions", {}).get("column"))
+
+
+def _hash_table(table_dir: Path, digest) -> None:
+	for fp in sorted(Path(table_dir).iterdir()):
+		digest.update(fp.name.encode())
+		with open(fp, "rb") as fh:
+			for block in iter(lambda: fh.read(1 << 20), b""):
+				digest.update(block)
+
+
+def write_manifest(data_dir: Path, users_dir: Path, events_dir: Path, parent: dict | None = None) -> dict:
+	# Small sidecar so freshness/validity checks and cache keys never have to
+	# touch the tables themselves. parent is the previous manifest when rows
+	# were only appended, so derived state can be extended instead of rebuilt
+	times = np.load(Path(events_dir) / "event_time.npy", mmap_mode="r")
+	digest = hashlib.blake2b(digest_size=16)
+	_hash_table(users_dir, digest)
+	_hash_table(events_dir, digest)
+	manifest = {
+		"schema_version": SCHEMA_VERSION,
+		"users": {"rows": read_schema(users_dir)["rows"]},
+		"events": {
+			"rows": len(times),
+			"min_event_time": str(pd.Timestamp(int(times.min()))) if len(times) else None,
+			"max_event_time": str(pd.Timestamp(int(times.max()))) if len(times) else None,
+		},
+		"content_hash": digest.hexdigest(),
+	}
+	if parent is not None:
+		manifest["parent"] = {
+			"content_hash": parent["content_hash"],
+			"users_rows": parent["users"]["rows"],
+			"events_rows": parent["events"]["rows"],
+		}
+	(Path(data_dir) / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+	return manifest
+
+
+def read_manifest(data_dir: Path) -> dict | None:
+	fp = Path(data_dir) / MANIFEST_FILE
+	if not fp.exists():
+		return None
+	manifest = json.loads(fp.read_text())
+	if manifest.get("schema_version") != SCHEMA_VERSION:
+		return None
+	return manifest
+
+
+class EventStore:
+	# The events table as three compact arrays: user_id (int32), event_code
+	# (uint8 into the catalog) and event_time (int64 ns). When opened from
+	# disk the arrays are read-only memmaps, so every process on the host
+	# shares one page-cached copy
+
+	def __init__(self, user_id: np.ndarray, event_code: np.ndarray, event_time: np.ndarray, event_names: list[str] | EventCatalog, partitions: tuple[np.ndarray, np.ndarray] | None = None):
+		# Rows must be sorted by event_time; partitions are derived lazily when
+		# not supplied
+		self.user_id = user_id
+		self.event_code = event_code
+		self.event_time = event_time
+		self.catalog = event_names if isinstance(event_names, EventCatalog) else EventCatalog(event_names)
+		self._partitions = partitions
+		self._code_offsets = None
+		self._code_rows = None
+		self._user_index = None
+		self._sequences = None
+
+	@classmethod
+	def open(cls, events_dir: Path, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None) -> "EventStore":
+		# With start/end only the rows in [start, end) are mapped
+		events_dir = Path(events_dir)
+		schema = read_schema(events_dir)
+		partitions = None
+		if "partitions" in schema:
+			partitions = (np.array(schema["partitions"]["keys"], dtype=np.int64), np.array(schema["partitions"]["offsets"], dtype=np.int64))
+		store = cls(
+			np.load(events_dir / "user_id.npy", mmap_mode="r"),
+			np.load(events_dir / "event_name.npy", mmap_mode="r"),
+			np.load(events_dir / "event_time.npy", mmap_mode="r"),
+			schema["columns"]["event_name"]["categories"],
+			partitions,
+		)
+		if partitions is None and np.any(np.diff(store.event_time) < 0):
+			# Tables written before partitioning carry no sort guarantee
+			store = store.take(np.argsort(store.event_time, kind="stable"))
+		if start is None and end is None:
+			return store
+		return store.between(start, end)
+
+	@classmethod
+	def from_frame(cls, events: pd.DataFrame) -> "EventStore":
+		names = events["event_name"]
+		if isinstance(names.dtype, pd.CategoricalDtype):
+			categories = [str(c) for c in names.cat.categories]
+			codes = names.cat.codes.to_numpy()
+		else:
+			codes, categories = pd.factorize(names, sort=True)
+			categories = [str(c) for c in categories]
+		times = pd.to_datetime(events["event_time"])
+		if times.dt.tz is not None:
+			times = times.dt.tz_localize(None)
+		if not times.is_monotonic_increasing:
+			order = np.argsort(times.to_numpy(), kind="stable")
+			events, codes, times = events.iloc[order], np.asarray(codes)[order], times.iloc[order]
+		return cls(
+			_narrow_int(events["user_id"].to_numpy()),
+			codes.astype(_code_dtype(len(categories))),
+			times.to_numpy(dtype="datetime64[ns]").view(np.int64),
+			categories,
+		)
+
+	@property
+	def event_names(self) -> list[str]:
+		return self.catalog.names
+
+	def __len__(self) -> int:
+		return len(self.event_time)
+
+	@property
+	def partitions(self) -> tuple[np.ndarray, np.ndarray]:
+		if self._partitions is None:
+			self._partitions = month_partitions(self.event_time)
+		return self._partitions
+
+	def partition_rows(self, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None) -> slice:
+		# Rows of the month partitions overlapping [start, end); rows outside
+		# the range can still occur at the edges of those partitions
+		keys, offsets = self.partitions
+		lo, hi = 0, len(keys)
+		if start is not None:
+			start_month = np.datetime64(pd.Timestamp(start).value, "ns").astype("datetime64[M]").astype(np.int64)
+			lo = int(np.searchsorted(keys, start_month, side="left"))
+		if end is not None:
+			end_month = np.datetime64(pd.Timestamp(end).value - 1, "ns").astype("datetime64[M]").astype(np.int64)
+			hi = int(np.searchsorted(keys, end_month, side="right"))
+		if hi <= lo:
+			return slice(0, 0)
+		return slice(int(offsets[lo]), int(offsets[hi]))
+
+	def time_slice(self, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None) -> slice:
+		# Exact rows with start <= event_time < end: partition pruning, then a
+		# binary search inside the overlapping partitions
+		rows = self.partition_rows(start, end)
+		times = self.event_time[rows]
+		lo = 0 if start is None else int(np.searchsorted(times, pd.Timestamp(start).value, side="left"))
+		hi = len(times) if end is None else int(np.searchsorted(times, pd.Timestamp(end).value, side="left"))
+		return slice(rows.start + lo, rows.start + max(lo, hi))
+
+	def between(self, start: pd.Timestamp | None = None, end: pd.Timestamp | None = None) -> "EventStore":
+		# Zero-copy view of [start, end); memmapped columns stay memmapped. A
+		# range covering every row returns the store itself, keeping its indexes
+		rows = self.time_slice(start, end)
+		if rows.start == 0 and rows.stop == len(self):
+			return self
+		return self.take(rows)
+
+	def take(self, rows: np.ndarray | slice) -> "EventStore":
+		# rows must be ascending (or a slice) to keep the store time-sorted
+		return EventStore(self.user_id[rows], self.event_code[rows], self.event_time[rows], self.catalog)
+
+	def rows(self, name: str) -> np.ndarray:
+		# Ascending (so time-ordered) row indices of one event, built for all
+		# events with a single stable sort of the code column on first use
+		if self._code_rows is None:
+			order = np.argsort(self.event_code, kind="stable")
+			self._code_rows = order.astype(np.int32) if len(order) < np.iinfo(np.int32).max else order
+			self._code_offsets = np.concatenate([[0], np.cumsum(np.bincount(self.event_code, minlength=len(self.catalog)))])
+		code = self.catalog.code(name)
+		if code < 0:
+			return self._code_rows[:0]
+		return self._code_rows[self._code_offsets[code]:self._code_offsets[code + 1]]
+
+	def user_index(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+		# CSR layout of rows per user: user u_ids[i] owns rows[offsets[i]:offsets[i + 1]],
+		# in time order. Built once per store with a stable sort on user_id
+		if self._user_index is None:
+			order = np.argsort(self.user_id, kind="stable")
+			u_ids, counts = np.unique(np.asarray(self.user_id)[order], return_counts=True)
+			offsets = np.concatenate([[0], np.cumsum(counts)])
+			self._user_index = (u_ids, offsets, order)
+		return self._user_index
+
+	def sequences(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+		# Per-user event sequences in CSR form: user u_ids[i] owns
+		# codes/times[offsets[i]:offsets[i + 1]], time-ordered
+		u_ids, offsets, order = self.user_index()
+		if self._sequences is None:
+			self._sequences = (np.asarray(self.event_code)[order], np.asarray(self.event_time)[order])
+		seq_codes, seq_times = self._sequences
+		return u_ids, offsets, seq_codes, seq_times
+
+	def rows_for_users(self, user_ids: np.ndarray) -> np.ndarray:
+		# Ascending rows of the given users, gathered from the per-user index
+		# instead of scanning the whole user_id column
+		u_ids, offsets, order = self.user_index()
+		pos = np.searchsorted(u_ids, user_ids)
+		pos = pos[(pos < len(u_ids)) & (u_ids[np.minimum(pos, len(u_ids) - 1)] == user_ids)] if len(u_ids) else pos[:0]
+		starts, lengths = offsets[pos], offsets[pos + 1] - offsets[pos]
+		total = int(lengths.sum())
+		shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+		rows = order[shift + np.arange(total)]
+		rows.sort()
+		return rows
+
+	def time_range(self) -> tuple[pd.Timestamp, pd.Timestamp]:
+		if not len(self):
+			return pd.NaT, pd.NaT
+		# Rows are time-sorted
+		return pd.Timestamp(int(self.event_time[0])), pd.Timestamp(int(self.event_time[-1]))
+
+	def code_frame(self, rows: np.ndarray | slice = slice(None)) -> pd.DataFrame:
+		# Like to_frame but keeps integer event codes, for code-based selection
+		return pd.DataFrame({
+			"user_id": np.asarray(self.user_id[rows]),
+			"event_code": np.asarray(self.event_code[rows]),
+			"event_time": np.asarray(self.event_time[rows]).view("datetime64[ns]"),
+		})
+
+	def to_frame(self) -> pd.DataFrame:
+		codes = np.asarray(self.event_code, dtype=np.int32)
+		codes[codes >= len(self.catalog)] = -1
+		return pd.DataFrame({
+			"user_id": np.asarray(self.user_id),
+			"event_name": pd.Categorical.from_codes(codes, categories=self.event_names),
+			"event_time": np.asarray(self.event_time).view("datetime64[ns]"),
+		})
+
+
+def as_event_store(events: "pd.DataFrame | EventStore") -> EventStore:
+	return events if isinstance(events, EventStore) else EventStore.from_frame(events)
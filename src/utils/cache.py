@@ -0,0 +1,79 @@
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+
+def estimate_nbytes(value) -> int:
+	# Memmaps count in full too: a cached view keeps its mapped pages in use
+	if isinstance(value, np.ndarray):
+		return value.nbytes
+	if isinstance(value, (pd.DataFrame, pd.Series)):
+		return int(value.memory_usage(index=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(index=True))
+	if isinstance(value, (tuple, list)):
+		return sum(estimate_nbytes(v) for v in value)
+	if isinstance(value, dict):
+		return sum(estimate_nbytes(v) for v in value.values())
+	if hasattr(value, "__dict__"):
+		return sum(estimate_nbytes(v) for v in vars(value).values())
+	return 0
+
+
+class LRUCache:
+	# Thread-safe (Streamlit serves sessions from threads) LRU map with a byte
+	# budget; the least recently used entries are evicted to stay under it
+
+	def __init__(self, max_bytes: int):
+		self.max_bytes = max_bytes
+		self._entries: OrderedDict = OrderedDict()
+		self._bytes = 0
+		self._lock = threading.Lock()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	@property
+	def nbytes(self) -> int:
+		return self._bytes
+
+	def get(self, key, default=None):
+		with self._lock:
+			if key not in self._entries:
+				return default
+			self._entries.move_to_end(key)
+			return self._entries[key][0]
+
+	def put(self, key, value, nbytes: int | None = None) -> None:
+		# nbytes overrides the estimate, e.g. to leave out shared objects
+		size = estimate_nbytes(value) if nbytes is None else nbytes
+		with self._lock:
+			if key in self._entries:
+				self._bytes -= self._entries.pop(key)[1]
+			if size > self.max_bytes:
+				return
+			self._entries[key] = (value, size)
+			self._bytes += size
+			while self._bytes > self.max_bytes:
+				_, (_, evicted) = self._entries.popitem(last=False)
+				self._bytes -= evicted
+
+	def resize(self, key, nbytes: int) -> None:
+		# Re-charges an entry that grew after put (e.g. lazily built indexes)
+		with self._lock:
+			if key not in self._entries:
+				return
+			value, size = self._entries[key]
+			if nbytes > self.max_bytes:
+				del self._entries[key]
+				self._bytes -= size
+				return
+			self._entries[key] = (value, nbytes)
+			self._bytes += nbytes - size
+			while self._bytes > self.max_bytes:
+				_, (_, evicted) = self._entries.popitem(last=False)
+				self._bytes -= evicted
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+			self._bytes = 0
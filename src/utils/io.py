@@ -1,39 +1,187 @@
+import logging
 import os
+import threading
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from src.data.generate import generate_datasets
+from src.data.generate import DEFAULT_SEED, generate_datasets, iter_shards, simulate_topup
+from src.data.store import EventStore, append_table, read_manifest, read_table, table_exists, write_manifest, write_table
 
 DATA_DIR = Path("data")
+USERS_DIR = DATA_DIR / "users"
+EVENTS_DIR = DATA_DIR / "events"
+# Beyond this the whole rolling window is stale and a rebuild is cheaper
+TOPUP_MAX_GAP_DAYS = 180
+
+try:
+	import fcntl
+except ImportError:  # Windows: only threads of this process are serialized
+	fcntl = None
+
+logger = logging.getLogger(__name__)
+_data_lock = threading.Lock()
+
+
+@contextmanager
+def data_dir_lock():
+	# Serializes dataset writes between sessions (threads) of this process
+	# and between processes sharing DATA_DIR. Not reentrant
+	with _data_lock:
+		DATA_DIR.mkdir(exist_ok=True)
+		with open(DATA_DIR / ".lock", "w") as lock_file:
+			if fcntl is not None:
+				fcntl.flock(lock_file, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				if fcntl is not None:
+					fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def import_csv(users_fp: Path = DATA_DIR / "users.csv", events_fp: Path = DATA_DIR / "events.csv"):
+	users = pd.read_csv(users_fp, parse_dates=["signup_time"])
+	events = pd.read_csv(events_fp, parse_dates=["event_time"])
+	write_table(users, USERS_DIR)
+	write_table(events, EVENTS_DIR, partition_by="event_time")
+	write_manifest(DATA_DIR, USERS_DIR, EVENTS_DIR)
+
+
+def export_csv(out_dir: Path = DATA_DIR):
+	users, events = load_datasets()
+	users.to_csv(Path(out_dir) / "users.csv", index=False)
+	events.to_csv(Path(out_dir) / "events.csv", index=False)
 
 
 def ensure_data_ready(force_refresh: bool = False):
-	DATA_DIR.mkdir(exist_ok=True)
-	users_fp = DATA_DIR / "users.csv"
-	events_fp = DATA_DIR / "events.csv"
-	need = force_refresh or (not users_fp.exists()) or (not events_fp.exists())
-	if not need and events_fp.exists():
-		try:
-			df = pd.read_csv(events_fp, parse_dates=["event_time"]) 
-			latest = df["event_time"].max().normalize()
-			if latest < pd.Timestamp.today().normalize():
+	# Checked on every run, so it only writes when the data is missing or
+	# stale; the lock makes concurrent sessions wait for one writer and then
+	# see its result
+	with data_dir_lock():
+		have_tables = table_exists(USERS_DIR) and table_exists(EVENTS_DIR)
+		if not have_tables and not force_refresh and (DATA_DIR / "users.csv").exists() and (DATA_DIR / "events.csv").exists():
+			try:
+				import_csv()
+				have_tables = True
+			except Exception:
+				pass
+		need = force_refresh or not have_tables
+		if not need:
+			try:
+				manifest = read_manifest(DATA_DIR) or write_manifest(DATA_DIR, USERS_DIR, EVENTS_DIR)
+			except Exception:
+				need = True
+		if not need:
+			latest = pd.Timestamp(manifest["events"]["max_event_time"]).normalize()
+			today = pd.Timestamp.today().normalize()
+			if (today - latest).days > TOPUP_MAX_GAP_DAYS:
 				need = True
-		except Exception:
-			need = True
-	if need:
-		users, events = generate_datasets()
-		users.to_csv(users_fp, index=False)
-		events.to_csv(events_fp, index=False)
+			elif latest < today:
+				# A failed top-up leaves the (stale but valid) dataset in place
+				# rather than regenerating it; the next run retries
+				try:
+					users, events = load_datasets()
+					new_users, new_events = simulate_topup(users, events, end=today)
+					append_table(new_users, USERS_DIR)
+					append_table(new_events, EVENTS_DIR)
+					write_manifest(DATA_DIR, USERS_DIR, EVENTS_DIR, parent=manifest)
+				except Exception:
+					logger.exception("Dataset top-up failed; keeping the existing data")
+		if need:
+			_regenerate_datasets()
+
+
+def dataset_fingerprint() -> str:
+	# Changes whenever the stored tables do; use it to key caches
+	manifest = read_manifest(DATA_DIR) or write_manifest(DATA_DIR, USERS_DIR, EVENTS_DIR)
+	return manifest["content_hash"]
+
+
+def dataset_parent() -> dict | None:
+	# The dataset this one was topped up from: its fingerprint and row counts.
+	# Rows past those counts are the appended batch
+	manifest = read_manifest(DATA_DIR)
+	return manifest.get("parent") if manifest else None
+
+
+def load_users() -> pd.DataFrame:
+	return read_table(USERS_DIR)
 
 
 def load_datasets():
-	users = pd.read_csv(DATA_DIR / "users.csv")
-	events = pd.read_csv(DATA_DIR / "events.csv", parse_dates=["event_time"])
+	users = load_users()
+	events = read_table(EVENTS_DIR)
 	return users, events
 
 
+def load_event_store(start: pd.Timestamp | None = None, end: pd.Timestamp | None = None) -> EventStore:
+	# Memory-mapped, so repeated opens and other processes share the page cache;
+	# start/end restrict it to the month partitions overlapping that range
+	return EventStore.open(EVENTS_DIR, start=start, end=end)
+
+
 def regenerate_datasets():
+	with data_dir_lock():
+		return _regenerate_datasets()
+
+
+def _regenerate_datasets():
 	users, events = generate_datasets()
-	(users, events)
-	users.to_csv(DATA_DIR / "users.csv", index=False)
-	events.to_csv(DATA_DIR / "events.csv", index=False)
+	write_table(users, USERS_DIR)
+	write_table(events, EVENTS_DIR, partition_by="event_time")
+	write_manifest(DATA_DIR, USERS_DIR, EVENTS_DIR)
 	return users, events
+
+
+def stream_datasets(num_users: int, chunk_size: int = 100_000, block_rows: int = 250_000, data_dir: Path = DATA_DIR, workers: int = 1, seed: int = DEFAULT_SEED) -> int:
+	# Simulate users chunk by chunk, spilling each chunk's events to its own
+	# time-sorted part file, then k-way merge the parts into events.csv
+	data_dir.mkdir(exist_ok=True)
+	parts_dir = data_dir / "parts"
+	parts_dir.mkdir(exist_ok=True)
+	users_fp = data_dir / "users.csv"
+	end_dt = pd.Timestamp.today().normalize()
+	parts = []
+	for i, (users, events) in enumerate(iter_shards(num_users, chunk_size, seed, end=end_dt, workers=workers)):
+		users.to_csv(users_fp, index=False, mode="w" if i == 0 else "a", header=i == 0)
+		part_fp = parts_dir / f"events-{i:05d}.csv"
+		events.to_csv(part_fp, index=False)
+		parts.append(part_fp)
+	total = _merge_event_parts(parts, data_dir / "events.csv", block_rows)
+	for part_fp in parts:
+		os.remove(part_fp)
+	parts_dir.rmdir()
+	return total
+
+
+def _merge_event_parts(parts: list[Path], out_fp: Path, block_rows: int) -> int:
+	# Readers share the block budget, so memory stays at about block_rows
+	# however many parts there are
+	chunk_rows = max(1, block_rows // max(1, len(parts)))
+	readers = [pd.read_csv(fp, parse_dates=["event_time"], chunksize=chunk_rows) for fp in parts]
+	buffers = [next(r, None) for r in readers]
+	done = [False] * len(readers)
+	total = 0
+	header = True
+	while any(b is not None and not b.empty for b in buffers):
+		# Rows up to the smallest buffered tail time can't be preceded by
+		# anything still on disk, so they are safe to emit
+		tails = [b["event_time"].iloc[-1] for b, d in zip(buffers, done) if b is not None and not b.empty and not d]
+		bound = min(tails) if tails else pd.Timestamp.max
+		ready = []
+		for i, b in enumerate(buffers):
+			if b is None or b.empty:
+				continue
+			n = int(np.searchsorted(b["event_time"].to_numpy(), bound.to_datetime64(), side="right"))
+			ready.append(b.iloc[:n])
+			buffers[i] = b.iloc[n:]
+			if buffers[i].empty and not done[i]:
+				buffers[i] = next(readers[i], None)
+				done[i] = buffers[i] is None
+		block = pd.concat(ready).sort_values("event_time", kind="stable")
+		block.to_csv(out_fp, index=False, mode="w" if header else "a", header=header)
+		header = False
+		total += len(block)
+	for r in readers:
+		r.close()
+	return total
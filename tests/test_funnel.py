@@ -0,0 +1,53 @@
+import unittest
+import pandas as pd
+from src.analytics.funnel import build_funnel
+from src.data.store import EventStore
+
+
+def _store(rows):
+	return EventStore.from_frame(pd.DataFrame({
+		"user_id": [r[0] for r in rows],
+		"event_name": [r[1] for r in rows],
+		"event_time": pd.to_datetime([r[2] for r in rows]),
+	}))
+
+
+class FunnelRepeatedStepsTest(unittest.TestCase):
+	window = pd.Timedelta(days=7)
+
+	def users(self, store, steps):
+		return build_funnel(store, steps, self.window)["users"].tolist()
+
+	def test_repeated_step_needs_a_second_event(self):
+		store = _store([
+			(1, "signup", "2026-01-01 10:00"),
+			(1, "view", "2026-01-01 11:00"),
+			(2, "activate", "2026-01-02 10:00"),
+			(2, "purchase", "2026-01-02 11:00"),
+		])
+		self.assertEqual(self.users(store, ["signup", "view", "signup"]), [1, 1, 0])
+		self.assertEqual(self.users(store, ["activate", "purchase", "activate"]), [1, 1, 0])
+
+	def test_tied_events_are_not_reused(self):
+		store = _store([
+			(1, "view", "2026-01-01 10:00"),
+			(1, "signup", "2026-01-01 10:00"),
+		])
+		self.assertEqual(self.users(store, ["view", "signup", "view"]), [1, 1, 0])
+		self.assertEqual(self.users(store, ["signup", "view"]), [1, 1])
+
+	def test_repeated_step_uses_a_later_event(self):
+		store = _store([
+			(1, "signup", "2026-01-01 10:00"),
+			(1, "view", "2026-01-01 11:00"),
+			(1, "signup", "2026-01-01 12:00"),
+			(2, "view", "2026-01-01 10:00"),
+			(2, "view", "2026-01-01 10:00"),
+			(2, "purchase", "2026-01-01 10:00"),
+		])
+		self.assertEqual(self.users(store, ["signup", "view", "signup"]), [1, 1, 1])
+		self.assertEqual(self.users(store, ["view", "view", "purchase"]), [2, 1, 1])
+
+
+if __name__ == "__main__":
+	unittest.main()
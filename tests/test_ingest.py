@@ -0,0 +1,26 @@
+import io
+import unittest
+import numpy as np
+from src.data.ingest import ingest_events_csv
+
+
+class IngestTimezoneTest(unittest.TestCase):
+	def test_mixed_offsets_and_naive_values(self):
+		csv = "\n".join([
+			"user_id,event_name,event_time",
+			"1,view,2026-03-28T10:00:00+01:00",
+			"1,view,2026-03-30T10:00:00+02:00",
+			"2,view,2026-03-30 09:00:00",
+			"2,signup,2026-03-30T09:30:00Z",
+			"3,view,not a time",
+		])
+		store, report, errors = ingest_events_csv(io.StringIO(csv))
+		self.assertEqual(errors, 1)
+		self.assertEqual(report["line"].tolist(), [6])
+		self.assertEqual(store.event_time.view("datetime64[ns]").tolist(), np.array([
+			"2026-03-28T09:00", "2026-03-30T08:00", "2026-03-30T09:00", "2026-03-30T09:30",
+		], dtype="datetime64[ns]").tolist())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,36 @@
+import tempfile
+import unittest
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from src.analytics.rollup import DailyRollup
+from src.data.segments import SegmentIndex
+from src.data.store import EventStore, write_table
+
+
+class RollupMissingNamesTest(unittest.TestCase):
+	def test_build_skips_events_without_name(self):
+		users = pd.DataFrame({
+			"user_id": [1, 2, 3],
+			"signup_time": pd.to_datetime(["2026-01-01"] * 3),
+			"acq_channel": ["paid", "seo", "paid"],
+			"country": ["US", "DE", "US"],
+		})
+		events = pd.DataFrame({
+			"user_id": [1, 2, 3, 1, 2],
+			"event_name": ["signup", None, "signup", np.nan, "purchase"],
+			"event_time": pd.to_datetime(["2026-01-01 10:00", "2026-01-01 11:00", "2026-01-02 09:00", "2026-01-02 10:00", "2026-01-03 12:00"]),
+		})
+		with tempfile.TemporaryDirectory() as tmp:
+			write_table(events, Path(tmp) / "events", partition_by="event_time")
+			store = EventStore.open(Path(tmp) / "events")
+			self.assertTrue((np.asarray(store.event_code) >= len(store.catalog)).any())
+			rollup = DailyRollup.build(store, SegmentIndex(users))
+			days, signups, _ = rollup.daily("signup")
+			self.assertEqual(signups.tolist(), [1, 1])
+			_, purchasers, _ = rollup.daily("purchase")
+			self.assertEqual(purchasers.tolist(), [1])
+
+
+if __name__ == "__main__":
+	unittest.main()
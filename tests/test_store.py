@@ -0,0 +1,22 @@
+import tempfile
+import unittest
+from pathlib import Path
+import pandas as pd
+from src.data.store import read_table, write_table
+
+
+class WriteTableTest(unittest.TestCase):
+	def test_overwrite_with_leftover_old_dir(self):
+		df = pd.DataFrame({"user_id": [1, 2], "country": ["US", "DE"]})
+		with tempfile.TemporaryDirectory() as tmp:
+			table_dir = Path(tmp) / "users"
+			write_table(df, table_dir)
+			leftover = Path(tmp) / "users.old"
+			leftover.mkdir()
+			(leftover / "stale.npy").write_bytes(b"")
+			write_table(df.iloc[:1], table_dir)
+			self.assertEqual(read_table(table_dir)["user_id"].tolist(), [1])
+
+
+if __name__ == "__main__":
+	unittest.main()